@@ -0,0 +1,241 @@
+# Helpers shared by the scripts that call Polygon API
+
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from hashlib import sha256
+from time import monotonic, sleep, time
+from urllib.parse import urlencode, urlparse
+
+import instrument
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache')
+
+# Requests per minute allowed by each Polygon plan.
+# Paid plans have no hard limit, but Polygon asks to stay under 100 requests/second.
+PLAN_RPM = {
+    'basic': 5,
+    'starter': 6000,
+    'developer': 6000,
+    'advanced': 6000,
+}
+
+
+class RateLimiter:
+    '''Token bucket shared by all threads making API requests'''
+
+    def __init__(self, rpm: float, burst: int = 1):
+        self.rate = rpm / 60  # tokens per second
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve a token even if it is not there yet, so waiting threads are served in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            with instrument.stage('rate limit wait'):
+                sleep(wait)
+
+
+class RateLimitedPool:
+    '''Wraps the connection pool of a RESTClient, so every request (including next pages) takes a token'''
+
+    def __init__(self, pool, limiter: RateLimiter):
+        self.pool = pool
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        self.limiter.acquire()
+        return self.pool.request(*args, **kwargs)
+
+
+API_NAMES = (
+    ('/v2/aggs/', 'aggs'),
+    ('/v3/reference/options/contracts', 'contracts'),
+    ('/v3/reference/splits', 'splits'),
+    ('/v3/reference/tickers/', 'ticker details'),
+)
+
+
+def api_name(url):
+    path = urlparse(url).path
+    return next((name for prefix, name in API_NAMES if path.startswith(prefix)), path)
+
+
+class InstrumentedPool:
+    '''Wraps the connection pool of a RESTClient to time requests and count pages and bytes per kind of API call'''
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def request(self, method, url, *args, **kwargs):
+        if not instrument.instruments.enabled:
+            return self.pool.request(method, url, *args, **kwargs)
+        name = api_name(url)
+        with instrument.stage(f'http {name}'):
+            resp = self.pool.request(method, url, *args, **kwargs)
+        instrument.count(f'{name} requests')
+        if 'cursor=' in url:
+            instrument.count(f'{name} next pages')
+        instrument.count(f'{name} bytes', len(resp.data or b''))
+        return resp
+
+
+class CachedResponse:
+    status = 200
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.headers = {}
+
+
+class ResponseCache:
+    '''
+    Stores API responses on disk keyed by a hash of the request URL and parameters.
+    Responses that cover only past days never change, so they never expire.
+    Responses that touch today (or have no date at all) expire after `ttl` seconds.
+    When the cache grows over `max_bytes` the least recently used responses are evicted.
+    '''
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'responses.sqlite'),
+                 max_bytes=2 * 1024**3, ttl=3600):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS response (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires REAL,
+            accessed REAL NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS response_accessed ON response(accessed)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+    @staticmethod
+    def request_key(method, url, fields):
+        query = urlencode(sorted((fields or {}).items()))
+        return sha256(f'{method} {url}?{query}'.encode()).hexdigest()
+
+    def expires(self, url, fields):
+        '''Returns when a response expires or None if it never does'''
+        text = url + ' ' + ' '.join(str(v) for v in (fields or {}).values())
+        days = [date.fromisoformat(d)
+                for d in re.findall(r'\b\d{4}-\d{2}-\d{2}\b', text)]
+        # next page URLs of aggregates have millisecond timestamps instead of dates
+        days += [date.fromtimestamp(int(t) / 1000)
+                 for t in re.findall(r'/(\d{13})(?=/|\?|$)', url)]
+        if days and max(days) < date.today():
+            return None
+        return time() + self.ttl
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT body, expires FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < time()):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute(
+                'UPDATE response SET accessed = ? WHERE key = ?', (time(), key))
+            self.db.commit()
+            return zlib.decompress(row[0])
+
+    def put(self, key, url, fields, data: bytes):
+        body = zlib.compress(data)
+        with self.lock:
+            old = self.db.execute(
+                'SELECT size FROM response WHERE key = ?', (key,)).fetchone()
+            if old:
+                self.size -= old[0]
+            self.db.execute(
+                'INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)',
+                (key, url, body, len(body), self.expires(url, fields), time()))
+            self.size += len(body)
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        while self.size > self.max_bytes:
+            rows = self.db.execute(
+                'SELECT key, size FROM response ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_bytes:
+                    break
+                self.db.execute('DELETE FROM response WHERE key = ?', (key,))
+                self.size -= size
+                self.evictions += 1
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        print(f'Response cache: {self.hits}/{total} hits ({ratio:.1%}), '
+              f'{self.evictions} evicted, {self.size / 1024**2:.1f} MB in {self.path}')
+
+
+class CachedPool:
+    '''Wraps the connection pool of a RESTClient to serve GET requests from a ResponseCache'''
+
+    def __init__(self, pool, cache: ResponseCache):
+        self.pool = pool
+        self.cache = cache
+
+    def request(self, method, url, fields=None, headers=None, **kwargs):
+        if method != 'GET':
+            return self.pool.request(method, url, fields=fields, headers=headers, **kwargs)
+        key = self.cache.request_key(method, url, fields)
+        data = self.cache.get(key)
+        if data is not None:
+            instrument.count('cache hits')
+            return CachedResponse(data)
+        instrument.count('cache misses')
+        resp = self.pool.request(method, url, fields=fields, headers=headers, **kwargs)
+        if resp.status == 200:
+            self.cache.put(key, url, fields, resp.data)
+        return resp
+
+
+def configure(client, base=None, rpm=None, workers=1, cache: ResponseCache = None):
+    '''
+    Prepares a RESTClient to be used concurrently by `workers` threads at most `rpm` requests/minute.
+    If `cache` is given, responses are served from it when possible and do not count against the rate limit.
+    '''
+    if base:
+        # e.g. a local stub server
+        client.BASE = base.rstrip('/')
+    # keep one open connection per worker instead of discarding them
+    client.client.connection_pool_kw['maxsize'] = max(1, workers)
+    client.client = InstrumentedPool(client.client)
+    if rpm:
+        client.client = RateLimitedPool(client.client, RateLimiter(rpm))
+    if cache:
+        client.client = CachedPool(client.client, cache)
+    client.cache = cache  # without it, stock.py does not keep the bars it fetches either
+    return client
+
+
+def parallel_map(fn, items, workers=1):
+    '''Like map() but runs on a thread pool. Results are in the order of items.'''
+    if workers <= 1:
+        return list(map(fn, items))
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(fn, items))
@@ -0,0 +1,52 @@
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+from model import load_history
+
+
+def timed(title, fn):
+    tracemalloc.start()
+    start = perf_counter()
+    result = fn()
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{title:<12} {elapsed * 1000:9.1f} ms {peak / 1024**2:9.1f} MB peak')
+    return result
+
+
+def sweep(history):
+    profit = 0
+    for i in range(100):
+        strike_gap = i / 1000
+        for w in history.week_data:
+            profit += w.find_strike(w.stock.prev.close * (1 + strike_gap)).profit_ratio
+    return profit
+
+
+def metrics(history):
+    return sum(c.leverage + c.profit_ratio + c.daily_tx + (c.max_price or 0)
+               for _ in range(10) for c in history.all_calls)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Stock symbol expected as argument', file=sys.stderr)
+        exit(1)
+
+    symbol = sys.argv[1]
+    print(f'data/{symbol}.pickle: {os.path.getsize(f"data/{symbol}.pickle") / 1024**2:.1f} MB')
+    history = timed('load', lambda: load_history(symbol))
+    print(history)
+    tracemalloc.start()
+    history = load_history(symbol)
+    print(f'{"in memory":<12} {tracemalloc.get_traced_memory()[0] / 1024**2:20.1f} MB')
+    tracemalloc.stop()
+    timed('sweep', lambda: sweep(history))
+    timed('metrics', lambda: metrics(history))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+'''
+Benchmarks of loading data, building transactions and parameter sweeps on synthetic data.
+
+Results can be saved as a JSON baseline and compared with a later run to find regressions:
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json
+'''
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from datetime import date, datetime, timedelta
+from time import perf_counter
+
+from polygon.rest.models import Agg, OptionsContract
+
+from model import OptionData, WeekData, History, load_history, save_history
+from stock import select_fridays
+from sweep import Sweep
+
+base_dir = os.path.dirname(os.path.realpath(__file__))
+full_dir = os.path.join(base_dir, 'full')
+
+
+def load_full_module(name):
+    '''Imports a module of the full directory, which has its own model.py'''
+    if full_dir not in sys.path:
+        sys.path.append(full_dir)
+    spec = importlib.util.spec_from_file_location(f'full_{name}', os.path.join(full_dir, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+full_file = load_full_module('file')
+full_model = load_full_module('model')
+
+
+def bar(r, d, price):
+    a = Agg(open=price, high=price * 1.02, low=price * 0.98, close=round(price * (1 + r.gauss(0, 0.01)), 2),
+            volume=r.randint(100, 10000), vwap=price,
+            timestamp=int(datetime.combine(d, datetime.min.time()).timestamp() * 1000),
+            transactions=r.randint(1, 1000))
+    a.date = d
+    return a
+
+
+def synthetic_data(symbol, weeks, contracts, bars, seed=0):
+    '''Data like full/fetch.py saves, with `contracts` per week and up to `bars` per contract'''
+    r = random.Random(seed)
+    day = date(2020, 1, 6)  # Monday
+    stock_history = []
+    price = 100.0
+    for i in range(weeks * 5):
+        d = day + timedelta(days=i // 5 * 7 + i % 5)
+        price = max(1.0, price * (1 + r.gauss(0.0005, 0.02)))
+        stock_history.append(bar(r, d, price))
+
+    weeklies = []
+    for friday in stock_history[4::5]:
+        options = []
+        for k in range(contracts):
+            strike = round(friday.close * (1 + k * 0.005), 1)
+            expiration_date = friday.date + timedelta(weeks=k % 26 + 1)
+            c = OptionsContract(ticker=f'O:{symbol}{expiration_date:%y%m%d}C{int(strike * 1000):08d}',
+                                contract_type='call', exercise_style='american',
+                                expiration_date=expiration_date.isoformat(), strike_price=strike,
+                                shares_per_contract=100, underlying_ticker=symbol)
+            option_price = max(0.01, friday.close * 0.03 * (1 - k / contracts) + r.random())
+            history = [bar(r, friday.date + timedelta(days=i // 5 * 7 + i % 5), option_price)
+                       for i in range(min(bars, (expiration_date - friday.date).days * 5 // 7))]
+            options.append({'contract': c, 'history': history})
+        weeklies.append({'day': friday, 'options': options})
+
+    return {
+        'symbol': symbol,
+        'from_date': stock_history[0].date,
+        'to_date': stock_history[-1].date,
+        'ticker_details': None,
+        'stock_splits': [],
+        'stock_history': stock_history,
+        'options_weekly': weeklies,
+    }
+
+
+def synthetic_history(data) -> History:
+    '''History with the options listed each week and sold on the next week'''
+    week_data = []
+    for w, next_w in zip(data['options_weekly'], data['options_weekly'][1:]):
+        start_day, end_day = w['day'], next_w['day']
+        end_day.prev = start_day
+        call_options = [OptionData(p['contract'], p['history'], start_day, end_day)
+                        for p in w['options'] if p['history']]
+        week_data.append(WeekData(end_day, call_options))
+    return History(data['symbol'], week_data, None, [])
+
+
+def measure(fn, repeat):
+    '''
+    Best time of `repeat` runs and the peak of memory allocated by a single run.
+    tracemalloc sees only memory allocated by Python, not the buffers of Arrow.
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            fn()
+            times.append(perf_counter() - start)
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def run(args):
+    symbols = [f'S{i:02d}' for i in range(args.symbols)]
+    tmp = tempfile.TemporaryDirectory()
+    full_data_dir = os.path.join(tmp.name, 'full')
+    history_data_dir = os.path.join(tmp.name, 'history')
+
+    all_data = {s: synthetic_data(s, args.weeks, args.contracts, args.bars, seed=i)
+                for i, s in enumerate(symbols)}
+    data = all_data[symbols[0]]
+    histories = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for s, d in all_data.items():
+            os.makedirs(full_data_dir, exist_ok=True)
+            os.chdir(full_data_dir)
+            full_file.save(d)
+            os.makedirs(history_data_dir, exist_ok=True)
+            os.chdir(history_data_dir)
+            histories[s] = synthetic_history(d)
+            save_history(histories[s])
+    history = histories[symbols[0]]
+
+    options = sum(len(w['options']) for w in data['options_weekly'])
+    option_bars = sum(len(p['history']) for w in data['options_weekly'] for p in w['options'])
+    calls = sum(len(w.call_options) for w in history.week_data)
+    strike_gaps = [i / 1000 for i in range(100)]
+    levers = [5 * 1.05 ** i for i in range(100)]
+
+    def in_dir(dir, fn):
+        def run():
+            os.chdir(dir)
+            return fn()
+        return run
+
+    # name -> (function, number of items it processes, item name)
+    benchmarks = {
+        'file.load': (in_dir(full_data_dir, lambda: full_file.load(symbols[0])), option_bars, 'option bars'),
+        'file.load_all': (in_dir(full_data_dir, full_file.load_all), option_bars * len(symbols), 'option bars'),
+        'file.Dataset week': (in_dir(full_data_dir, lambda: full_file.Dataset()[symbols[0]]['options_weekly'][-1]),
+                              len(data['options_weekly'][-1]['options']), 'options'),
+        'file.load_option_bars': (in_dir(full_data_dir, lambda: full_file.load_option_bars([symbols[0]])),
+                                  option_bars, 'option bars'),
+        'create_transactions': (lambda: full_model.create_transactions(data), options, 'options'),
+        'load_transactions': (in_dir(full_data_dir, lambda: full_model.load_transactions(symbols[0])),
+                              options, 'options'),
+        'select_fridays': (lambda: select_fridays(data['stock_history']),
+                           len(data['stock_history']), 'days'),
+        'load_history': (in_dir(history_data_dir, lambda: load_history(symbols[0])), calls, 'calls'),
+        'WeekData.find_strike': (lambda: [w.find_strike(w.stock.prev.close * (1 + g))
+                                          for g in strike_gaps for w in history.week_data],
+                                 len(strike_gaps) * len(history.week_data), 'queries'),
+        'WeekData.find_lever': (lambda: [w.find_lever(lever)
+                                         for lever in levers for w in history.week_data],
+                                len(levers) * len(history.week_data), 'queries'),
+        'sweep strike-gap': (lambda: Sweep(history).strike_gap(strike_gaps),
+                             len(strike_gaps) * len(history.week_data), 'queries'),
+        'sweep lever': (lambda: Sweep(history).lever(levers),
+                        len(levers) * len(history.week_data), 'queries'),
+    }
+
+    results = {}
+    for name, (fn, items, unit) in benchmarks.items():
+        if args.only and not any(o in name for o in args.only):
+            continue
+        seconds, peak = measure(fn, args.repeat)
+        results[name] = {
+            'seconds': seconds,
+            'items': items,
+            'unit': unit,
+            'throughput': items / seconds,
+            'peak_memory': peak,
+        }
+        print(f'{name:<24} {seconds * 1000:10.2f} ms {items / seconds:14,.0f} {unit}/s '
+              f'{peak / 1024**2:9.1f} MB peak')
+    os.chdir(base_dir)
+    tmp.cleanup()
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''Prints the change of each benchmark and returns the names of the ones slower than threshold'''
+    regressions = []
+    print(f'\nCompared with baseline:')
+    for name, r in results.items():
+        b = baseline.get(name)
+        if not b:
+            continue
+        change = r['seconds'] / b['seconds'] - 1
+        memory_change = r['peak_memory'] / b['peak_memory'] - 1 if b['peak_memory'] else 0
+        slower = change > threshold
+        if slower:
+            regressions.append(name)
+        print(f'{name:<24} time {change:+7.1%} memory {memory_change:+7.1%}'
+              f'{"  REGRESSION" if slower else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weeks', type=int, default=104)
+    parser.add_argument('--contracts', type=int, default=20, help='contracts per week')
+    parser.add_argument('--bars', type=int, default=20, help='max bars per contract')
+    parser.add_argument('--symbols', type=int, default=3, help='number of symbols for load_all')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best one counts')
+    parser.add_argument('--only', nargs='*', help='run only benchmarks with one of these in the name')
+    parser.add_argument('--save', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', help='compare the results with a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown reported as a regression (default: 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    config = {k: getattr(args, k) for k in ('weeks', 'contracts', 'bars', 'symbols')}
+    print(f'Synthetic data: {config}')
+    results = run(args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=4)
+        print(f'Results saved in {args.save}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print(f'WARNING: baseline was measured on different data: {baseline["config"]}')
+        if compare(results, baseline['results'], args.threshold):
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
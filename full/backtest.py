@@ -0,0 +1,210 @@
+'''
+Walk-forward portfolio backtest of buying calls each week over many symbols.
+
+Unlike the sums of profit ratios in test-strike-gap.py, the portfolio has limited cash:
+each week it spends a fraction of its equity on one call per symbol and gets the value
+of the calls back when they expire, so positions overlap and gains are compounded.
+Many strategies (strike gap, weeks to expiration) are simulated at once over arrays.
+'''
+
+import argparse
+import contextlib
+import io
+import numpy as np
+import pandas as pd
+
+from model import load_transactions, store_transactions
+import instrument
+
+
+class Portfolio:
+    '''The calls that can be bought each week of a set of symbols'''
+
+    def __init__(self, transactions: dict[str, pd.DataFrame]):
+        self.symbols = list(transactions)
+        self.days = np.unique(np.concatenate(
+            [tx['buy_date'].to_numpy('datetime64[D]') for tx in transactions.values()]))
+        self.calls = []
+        for tx in transactions.values():
+            buy = np.searchsorted(self.days, tx['buy_date'].to_numpy('datetime64[D]'))
+            # positions are closed on the first day at or after expiration
+            sell = np.searchsorted(self.days, tx['sell_date'].to_numpy('datetime64[D]'))
+            stock_start = tx['stock_start_price'].to_numpy()
+            strike = tx['strike'].to_numpy()
+            # value of the call at expiration per unit of money spent on it
+            value = np.maximum(tx['stock_end_price'].to_numpy() - strike, 0) / tx['buy_price'].to_numpy()
+            self.calls.append({
+                'buy': buy,
+                'sell': sell,
+                'weeks': tx['weeks'].to_numpy(),
+                'gap': strike / stock_start - 1,
+                'value': value,
+            })
+
+    @instrument.timed('Portfolio.choices')
+    def choices(self, strategies):
+        '''
+        Value ratio and sell day (strategies x days x symbols) of the call each strategy buys,
+        which is the one with the nearest strike gap to the (gap, weeks) of the strategy.
+        NaN where there is no such call.
+        '''
+        shape = (len(strategies), len(self.days), len(self.symbols))
+        value = np.full(shape, np.nan)
+        sell = np.zeros(shape, dtype=int)
+        gaps = np.array([g for g, _ in strategies])
+        weeks = np.array([w for _, w in strategies])
+        for n, calls in enumerate(self.calls):
+            for w in np.unique(weeks):
+                # calls of these weeks grouped by buy day, in the order they were listed
+                selected = np.flatnonzero(calls['weeks'] == w)
+                selected = selected[np.argsort(calls['buy'][selected], kind='stable')]
+                if not len(selected):
+                    continue
+                buy = calls['buy'][selected]
+                starts = np.flatnonzero(np.append(True, buy[1:] != buy[:-1]))
+                s = np.flatnonzero(weeks == w)
+                distance = np.abs(calls['gap'][selected][None, :] - gaps[s, None])
+                nearest = np.minimum.reduceat(distance, starts, axis=1)
+                # position of the first nearest call of each day
+                is_nearest = distance == np.repeat(nearest, np.diff(np.append(starts, len(selected))), axis=1)
+                countdown = len(selected) - np.arange(len(selected))
+                first = selected[len(selected) - np.maximum.reduceat(np.where(is_nearest, countdown, 0),
+                                                                     starts, axis=1)]
+                value[s[:, None], buy[starts], n] = calls['value'][first]
+                sell[s[:, None], buy[starts], n] = calls['sell'][first]
+        return value, sell
+
+
+@instrument.timed()
+def simulate(value, sell, allocation, start=0, stop=None, equity=1.0):
+    '''
+    Runs the strategies from the start day to the stop day (excluded) and returns their equity
+    on each day (strategies x days). Open positions count at their cost until they are sold.
+    Each day, allocation of the equity is split evenly between the symbols, as long as there is cash.
+    '''
+    strategies, days, symbols = value.shape
+    stop = days if stop is None else stop
+    rows = np.arange(strategies)
+    cash = np.full(strategies, equity, dtype=float)
+    # money returned and cost of the positions to be sold on each day, the last one after all days
+    returns = np.zeros((strategies, days + 1))
+    costs = np.zeros((strategies, days + 1))
+    invested = np.zeros(strategies)
+    curve = np.full((strategies, days), np.nan)
+    for t in range(start, stop):
+        cash += returns[:, t]
+        invested -= costs[:, t]
+        curve[:, t] = cash + invested
+        budget = allocation * curve[:, t] / symbols
+        for n in range(symbols):
+            v = value[:, t, n]
+            amount = np.where(np.isnan(v), 0, np.minimum(budget, cash))
+            cash -= amount
+            invested += amount
+            exit = np.minimum(sell[:, t, n], days)
+            returns[rows, exit] += amount * np.nan_to_num(v)
+            costs[rows, exit] += amount
+    # positions still open at the stop day are sold at their value when they expire
+    final = cash + returns[:, stop:].sum(axis=1)
+    return curve[:, start:stop], final
+
+
+def max_drawdown(curve):
+    '''Largest drop from a previous high of each curve, NaN for curves without days'''
+    if curve.shape[-1] == 0:
+        return np.full(curve.shape[:-1], np.nan)[()]
+    return (1 - curve / np.maximum.accumulate(curve, axis=-1)).max(axis=-1)
+
+
+@instrument.timed()
+def walk_forward(portfolio, strategies, allocation, train, test):
+    '''
+    Every `test` days, picks the strategy with the highest return over the previous `train` days
+    (counting only positions sold within them) and uses it for the next `test` days.
+    Returns the strategy used on each day (-1 before the first pick) and the equity curve.
+    '''
+    days = len(portfolio.days)
+    if train < 1 or test < 1 or train >= days:
+        raise ValueError(f'train ({train}) and test ({test}) must be at least 1 and train less than the {days} days')
+    value, sell = portfolio.choices(strategies)
+    schedule = np.full(days, -1)
+    for start in range(train, days, test):
+        # calls sold after the training days are not known yet
+        _, final = simulate(np.where(sell >= start, np.nan, value), sell, allocation, start - train, start)
+        schedule[start:start + test] = np.argmax(final)
+    # the calls bought each day by the strategy picked for that day
+    days_index = np.arange(days)
+    picked = np.maximum(schedule, 0)
+    scheduled_value = np.where((schedule >= 0)[:, None], value[picked, days_index], np.nan)[None]
+    scheduled_sell = sell[picked, days_index][None]
+    curve, final = simulate(scheduled_value, scheduled_sell, allocation, train)
+    return schedule, curve[0], final[0]
+
+
+@instrument.timed()
+def load_portfolio(symbols, use_store=False) -> Portfolio:
+    if use_store:
+        import store
+        s = store.Store()
+    with contextlib.redirect_stdout(io.StringIO()):  # warnings about missing prices
+        transactions = {symbol: store_transactions(s, symbol) if use_store else load_transactions(symbol)
+                        for symbol in symbols}
+    return Portfolio(transactions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('symbols', nargs='+')
+    parser.add_argument('--gaps', type=float, nargs=3, default=(0, 10, 1), metavar=('START', 'END', 'STEP'),
+                        help='strike gaps in %% (default: 0 10 1)')
+    parser.add_argument('--weeks', type=int, nargs='+', default=list(range(1, 9)),
+                        help='weeks to expiration (default: 1 - 8)')
+    parser.add_argument('--allocation', type=float, default=0.1,
+                        help='part of the equity spent each week (default: 0.1)')
+    parser.add_argument('--train', type=int, default=26, help='weeks to pick a strategy on (default: 26)')
+    parser.add_argument('--test', type=int, default=4, help='weeks to use a picked strategy for (default: 4)')
+    parser.add_argument('--store', action='store_true', help='use the local database instead of the tables')
+    parser.add_argument('--output', help='save the walk-forward equity curve to this CSV file')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.train < 1 or args.test < 1:
+        parser.error('--train and --test must be at least 1')
+    instrument.configure(args)
+
+    start, end, step = args.gaps
+    gaps = np.arange(start, end + step / 2, step) / 100
+    strategies = [(g, w) for w in args.weeks for g in gaps]
+    portfolio = load_portfolio(args.symbols, args.store)
+    print(f'{len(portfolio.symbols)} symbols, {len(portfolio.days)} weeks, {len(strategies)} strategies')
+
+    value, sell = portfolio.choices(strategies)
+    curve, final = simulate(value, sell, args.allocation)
+    df = pd.DataFrame({
+        'strike_gap': [g for g, _ in strategies],
+        'weeks': [w for _, w in strategies],
+        'return': final - 1,
+        'max_drawdown': max_drawdown(curve),
+    })
+    with pd.option_context('display.max_rows', None, 'display.width', None,
+                           'display.float_format', '{:.3f}'.format):
+        print('Best strategies over all weeks:')
+        print(df.sort_values('return', ascending=False).head(10).to_string(index=False))
+
+    if args.train >= len(portfolio.days):
+        print(f'WARN: no walk-forward test, --train {args.train} is not less than the {len(portfolio.days)} weeks')
+        instrument.finish()
+        return
+    schedule, curve, final = walk_forward(portfolio, strategies, args.allocation, args.train, args.test)
+    print(f'\nWalk-forward ({args.train} weeks train, {args.test} weeks test):')
+    for start in range(args.train, len(portfolio.days), args.test):
+        gap, weeks = strategies[schedule[start]]
+        print(f'{portfolio.days[start]}: strike gap {gap:+.1%}, {weeks} weeks')
+    print(f'return {final - 1:+.1%}, max drawdown {max_drawdown(curve):.1%}')
+    if args.output:
+        pd.DataFrame({'date': portfolio.days[args.train:], 'equity': curve}).to_csv(args.output, index=False)
+    instrument.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+# Check that create_transactions_df gives exactly the same transactions as create_transactions
+
+import os
+import sys
+import pandas as pd
+from file import load
+from model import create_transactions, load_transactions
+
+
+def main():
+    symbols = sys.argv[1:] or sorted(f.removesuffix('.pickle')
+                                     for f in os.listdir('data') if f.endswith('.pickle'))
+    for symbol in symbols:
+        expected = pd.DataFrame(create_transactions(load(symbol)))
+        for c in ('buy_date', 'sell_date'):
+            expected[c] = pd.to_datetime(expected[c]).astype('datetime64[ms]')
+        actual = load_transactions(symbol)
+        pd.testing.assert_frame_equal(actual, expected, check_exact=True, check_dtype=False)
+        print(f'{symbol}: {len(actual)} transactions match')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+# Save the pickles again in the current format, with their columnar tables and week files,
+# e.g. the ones fetched before they were introduced
+
+import os
+import sys
+from file import load, save
+
+
+def main():
+    symbols = sys.argv[1:] or sorted(f.removesuffix('.pickle')
+                                     for f in os.listdir('data') if f.endswith('.pickle'))
+    for symbol in symbols:
+        print(f'{symbol}...')
+        data = load(symbol)
+        save(data)
+
+
+if __name__ == "__main__":
+    main()
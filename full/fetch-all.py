@@ -0,0 +1,279 @@
+'''
+Fetch all data of many symbols, like running fetch.py for each of them, but with a single API client,
+connection pool and rate limit shared by all of them.
+
+All requests go through one queue of tasks, run by --workers threads in this order:
+1. the stock data of each symbol (details, splits and daily bars), which tells the weeks to fetch
+2. the call contracts of each week of each symbol, which tell how many option histories there are
+3. the history of each contract, symbol by symbol and week by week, once for all the weeks it is listed in
+so the amount of work is known early and the symbols are completed one after the other.
+Each week is written to data/<SYMBOL>.chunks as soon as it is complete, so an interrupted run resumes like fetch.py.
+'''
+
+import argparse
+import itertools
+import os
+import queue
+import sys
+import threading
+from time import monotonic
+
+import fetch
+from fetch import list_call_contracts, list_option_history, print_options, read_log, start_fetch
+from file import ChunkLog, compact, expand, history_from, save
+
+sys.path.append(os.path.dirname(fetch.base_dir))  # shared modules in the repo root
+import instrument
+from api import PLAN_RPM, ResponseCache, configure
+from stock import select_fridays
+from store import Store
+
+# kinds of tasks, in the order they are run
+STOCK, CONTRACTS, HISTORY = range(3)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    m, s = divmod(round(seconds), 60)
+    h, m = divmod(m, 60)
+    return f'{h}h{m:02}m' if h else f'{m}m{s:02}s'
+
+
+class SymbolFetch:
+    '''Progress of a symbol: the weeks being fetched and the tasks known so far'''
+
+    def __init__(self, symbol, order):
+        self.symbol = symbol
+        self.order = order
+        self.log = ChunkLog(f'data/{symbol}.chunks')
+        self.fridays = []
+        self.options = {}  # week -> options, as soon as the contracts are listed
+        self.pending = {}  # week -> histories not fetched yet
+        self.option_bars = {}  # ticker -> bars from the first week it is listed in
+        self.bars_week = {}  # ticker -> week its bars start at, -1 for weeks fetched before
+        self.waiting = {}  # ticker -> (week, position) of the options waiting for its history
+        self.listed = 0  # weeks whose contracts are listed
+        self.written = 0  # weeks written to the log, in order
+        self.tasks = 1  # the stock data, then contract lists and histories as they are known
+        self.done = 0
+        self.error = None
+        self.saved = False
+        self.lock = threading.Lock()
+
+    def unlisted_weeks(self):
+        return len(self.fridays) - self.listed
+
+
+class FetchQueue:
+    def __init__(self, symbols, workers=1, update=False, use_store=True):
+        self.symbols = [SymbolFetch(symbol, i) for i, symbol in enumerate(symbols)]
+        self.workers = workers
+        self.update = update
+        self.use_store = use_store
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()  # keeps tasks of the same priority in the order they were added
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.done = 0
+
+    def put(self, kind, s, week, index, fn, *args):
+        self.queue.put(((kind, s.order, week, index, next(self.sequence)), (s, fn, args)))
+
+    def run(self):
+        for s in self.symbols:
+            self.put(STOCK, s, 0, 0, self.fetch_stock)
+        threads = [threading.Thread(target=self.work) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+        self.queue.join()
+        for _ in threads:
+            self.queue.put(((HISTORY + 1,), None))
+        for t in threads:
+            t.join()
+
+    def work(self):
+        while True:
+            _, task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            s, fn, args = task
+            try:
+                if s.error is None:
+                    fn(s, *args)
+            except Exception as e:
+                s.error = e
+                print(f'WARN: fetch of {s.symbol} failed: {e!r} - run again to resume it')
+            finally:
+                with self.lock:
+                    self.done += 1
+                    s.done += 1
+                self.queue.task_done()
+
+    def fetch_stock(self, s):
+        stock_data, last_friday, s.option_bars = read_log(s.log)
+        if stock_data:
+            print(f'Resuming fetch of {s.symbol} after {last_friday or "the start"}')
+        else:
+            with instrument.stage('fetch stock data'):
+                start_fetch(s.symbol, s.log, self.update)
+            stock_data, last_friday, s.option_bars = read_log(s.log)
+        s.bars_week = dict.fromkeys(s.option_bars, -1)
+        s.fridays = [d for d in select_fridays(stock_data['stock_history'])
+                     if not last_friday or d.date > last_friday]
+        with self.lock:
+            s.tasks += len(s.fridays)
+        for week in range(len(s.fridays)):
+            self.put(CONTRACTS, s, week, 0, self.list_contracts, week)
+        if not s.fridays:
+            self.write_weeks(s)
+
+    def list_contracts(self, s, week):
+        contracts = list_call_contracts(s.symbol, s.fridays[week])
+        new = []
+        with s.lock, self.lock:
+            s.options[week] = [{'contract': c, 'history': None} for c in contracts]
+            s.pending[week] = 0
+            for i, c in enumerate(contracts):
+                # bars fetched for a later week, listed first, lack the days of this one and are fetched again
+                if c.ticker in s.option_bars and s.bars_week[c.ticker] <= week:
+                    s.options[week][i]['history'] = history_from(s.option_bars[c.ticker], s.fridays[week].date)
+                    continue
+                # the history of a contract is fetched once for all the weeks it is listed in
+                if c.ticker not in s.waiting:
+                    s.waiting[c.ticker] = []
+                    new.append(c)
+                s.waiting[c.ticker].append((week, i))
+                s.pending[week] += 1
+            s.listed += 1
+            s.tasks += len(new)
+        for i, c in enumerate(new):
+            self.put(HISTORY, s, week, i, self.fetch_history, c)
+        if not s.pending[week]:
+            self.write_weeks(s)
+
+    def fetch_history(self, s, contract):
+        ticker = contract.ticker
+        with s.lock:
+            start = min(week for week, _ in s.waiting[ticker])
+        bars = list_option_history(contract, s.fridays[start])
+        with s.lock:
+            waiting = s.waiting[ticker]
+            first = min(week for week, _ in waiting)
+            if first == start:
+                del s.waiting[ticker]
+                s.option_bars[ticker] = bars
+                s.bars_week[ticker] = start
+                for week, i in waiting:
+                    s.options[week][i]['history'] = history_from(bars, s.fridays[week].date)
+                    s.pending[week] -= 1
+        if first < start:
+            # an earlier week listed it while it was fetched, so it has to start from that week
+            with self.lock:
+                s.tasks += 1
+            self.put(HISTORY, s, first, 0, self.fetch_history, contract)
+            return
+        self.write_weeks(s)
+
+    def write_weeks(self, s):
+        '''Writes the complete weeks that follow the last written one, and saves the symbol after the last week'''
+        with s.lock:
+            while s.written < len(s.fridays) and s.pending.get(s.written) == 0:
+                d = s.fridays[s.written]
+                options = s.options.pop(s.written)
+                print_options(d, options)
+                with instrument.stage('write log'):
+                    s.log.append({'day': d, 'options': options})
+                s.written += 1
+                print(f'{s.symbol}: {s.written}/{len(s.fridays)} weeks, ETA {format_duration(self.eta(s))}')
+            if s.written == len(s.fridays) and not s.saved:
+                self.save(s)
+                s.saved = True
+
+    def save(self, s):
+        with instrument.stage('save'):
+            records = s.log.records()
+            stock_data = next(records)
+            stock_data['options_weekly'] = records
+            # the bars of each contract are kept once, the weeks are built again one at a time while saving
+            stock_data = expand(compact(stock_data), lazy=True)
+            save(stock_data)
+        if self.use_store:
+            with instrument.stage('save store'):
+                Store().save_symbol(stock_data)
+        s.log.remove()
+
+    def eta(self, s):
+        '''
+        Estimated time until the last task of a symbol is done: all tasks before it in the queue (the ones
+        of the earlier symbols, and contract lists of all) are done first. Weeks whose contracts are not listed
+        yet are counted with the average number of contracts of the listed weeks.
+        '''
+        with self.lock:
+            elapsed = monotonic() - self.start
+            if not self.done:
+                return None
+            listed = [(t.listed, t.tasks - 1 - len(t.fridays)) for t in self.symbols]
+            weeks = sum(w for w, _ in listed)
+            contracts_per_week = sum(c for _, c in listed) / weeks if weeks else 0
+            remaining = sum(t.tasks - t.done + t.unlisted_weeks() * contracts_per_week
+                            for t in self.symbols if t.order <= s.order and t.error is None)
+            remaining += sum(t.unlisted_weeks() for t in self.symbols if t.order > s.order and t.error is None)
+            return remaining * elapsed / self.done
+
+    def print_summary(self):
+        print(f'\n{len(self.symbols)} symbols, {self.done} tasks in {format_duration(monotonic() - self.start)}:')
+        for s in self.symbols:
+            status = 'saved' if s.saved else f'failed ({s.error!r})' if s.error else 'not complete'
+            print(f'{s.symbol:<8} {len(s.fridays):>4} weeks {s.done:>7} tasks  {status}')
+
+
+def leverage_symbols():
+    '''Symbols that have a file in option_leverage'''
+    return sorted(f.removesuffix('.json') for f in os.listdir('option_leverage')
+                  if f.endswith('.json') and f != 'sources.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('symbols', nargs='*',
+                        help='stock symbols (default: all symbols in option_leverage)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of concurrent requests (default: 1)')
+    parser.add_argument('--plan', choices=PLAN_RPM.keys(),
+                        help='Polygon plan to take the rate limit from')
+    parser.add_argument('--rpm', type=float,
+                        help='max requests per minute (overrides --plan)')
+    parser.add_argument('--base-url',
+                        help='API base URL, e.g. of a local stub server')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the local response cache')
+    parser.add_argument('--update', action='store_true',
+                        help='extend previously saved data with the new weeks only')
+    parser.add_argument('--no-store', action='store_true',
+                        help='do not write the data into the local database (store.py)')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrument.configure(args)
+    rpm = args.rpm or PLAN_RPM.get(args.plan)
+    cache = None if args.no_cache else ResponseCache()
+    # one client for all symbols, so they share its connections and rate limit
+    configure(fetch.client, base=args.base_url, rpm=rpm, workers=args.workers, cache=cache)
+
+    os.makedirs('data', exist_ok=True)
+    fetch_queue = FetchQueue(args.symbols or leverage_symbols(), args.workers, args.update, not args.no_store)
+    fetch_queue.run()
+    fetch_queue.print_summary()
+    if cache:
+        cache.print_stats()
+    instrument.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,27 @@
-# Fetch all data for a given symbol from Polygon API and save it to a file
+'''Fetch all data for a given symbol from Polygon API and save it to a file'''
 
-from datetime import date
-from itertools import pairwise
+import argparse
+from datetime import date, timedelta
 import os
 import pickle
 from statistics import median
 import sys
 from polygon import RESTClient
-from file import save
+from polygon.rest.models import OptionsContract
+from file import ChunkLog, compact, expand, history_from, load, save
 
 client = RESTClient()  # POLYGON_API_KEY environment variable is used
 
 base_dir = os.path.dirname(os.path.realpath(__file__))
 
+sys.path.append(os.path.dirname(base_dir))  # shared modules in the repo root
+import instrument
+from api import PLAN_RPM, ResponseCache, configure, parallel_map
+from stock import list_stock_history, select_fridays
+from store import CHAIN, Store
 
+
+@instrument.timed()
 def list_stock_splits(symbol, from_date, to_date):
     splits = list(client.list_splits(symbol,
                                      execution_date_gte=from_date,
@@ -26,17 +34,7 @@ def list_stock_splits(symbol, from_date, to_date):
     return splits
 
 
-def list_stock_history(symbol, from_date, to_date):
-    aggs = list(client.list_aggs(
-        symbol,
-        1, 'day',
-        from_date, to_date,
-        adjusted=False))
-    for a in aggs:
-        a.date = date.fromtimestamp(a.timestamp/1000)
-    print(f'Fetched stock history for {len(aggs)} days')
-    return aggs
-
+@instrument.timed()
 def list_option_history(contract, start_day):
     aggs = list(client.list_aggs(
         contract.ticker,
@@ -54,22 +52,7 @@ def list_option_history(contract, start_day):
     #         f'{contract.ticker}: history starts on {aggs[0].date} after {start_day.date}')
     return aggs
 
-def select_fridays(aggs):
-    h = []
-    for a, next_a in pairwise(aggs):
-        if a.date >= next_a.date:
-            raise Exception(
-                f'bad stock history order: {a.date} >= {next_a.date}')
-        if a.date.isoweekday() > next_a.date.isoweekday():
-            h.append(a)
-    Friday = 5
-    last_a = aggs[-1]
-    if last_a.date.isoweekday() == Friday:
-        h.append(last_a)
-    print(f'Found {len(h)} weeks')
-    return h
-
-
+@instrument.timed()
 def list_call_contracts(symbol, start_day):
     contracts = client.list_options_contracts(
         symbol,
@@ -89,65 +72,289 @@ def list_call_contracts(symbol, start_day):
             last = c
     return result        
 
-def fetch_options(symbol, start_day):
+@instrument.timed()
+def list_chain_contracts(symbol, start_day, band):
+    '''Returns all calls and puts listed on start_day with a strike price within band of the close price'''
+    return list(client.list_options_contracts(
+        symbol,
+        as_of=start_day.date,
+        strike_price_gte=round(start_day.close * (1 - band), 2),
+        strike_price_lte=round(start_day.close * (1 + band), 2),
+        sort='expiration_date',
+        order='asc',
+        limit=1000))
+
+def print_options(start_day, options):
+    if not options:
+        print(f'{start_day.date}: no call contracts')
+        return
+    hl = [len(c['history']) for c in options]
+    minh = min(hl)
+    maxh = max(hl)
+    midh = round(median(hl))
+    print(f'{start_day.date}: {len(options)} contracts, history length: min {minh}, median {midh}, max {maxh}')
+
+def fetch_options(symbol, start_day, option_bars):
+    '''
+    Returns the call contracts listed on start_day with their history from that day.
+    option_bars has the bars of the contracts fetched for earlier weeks, which are not fetched again.
+    '''
     result = []
     contracts = list_call_contracts(symbol, start_day)
-    if not contracts:
-        print(f'{start_day.date}: no call contracts')
-        return result
     for c in contracts:
-        oh = list_option_history(c, start_day)
+        if c.ticker not in option_bars:
+            option_bars[c.ticker] = list_option_history(c, start_day)
         result.append({
             'contract': c,
-            'history': oh
+            'history': history_from(option_bars[c.ticker], start_day.date)
         })
-    hl = [len(c['history']) for c in result]
-    minh = min(hl)
-    maxh = max(hl)
-    midh = round(median(hl))
-    print(f'{start_day.date}: {len(result)} contracts, history length: min {minh}, median {midh}, max {maxh}')
+    print_options(start_day, result)
     return result
         
-def fetch_options_weekly(symbol, stock_history):
+def fetch_options_weekly(symbol, stock_history, workers=1, after=None, option_bars=None):
+    '''
+    Yields the options of each week (after the given date) as soon as they are fetched.
+    The history of a contract is fetched only for the first week it is listed in (or found in option_bars)
+    and the next weeks get the part of it from their day.
+    '''
+    option_bars = {} if option_bars is None else option_bars
     fridays = select_fridays(stock_history)
-    weeklies = []
-    for i, d in enumerate(fridays):
-      print(f'{i+1}/{len(fridays)}...')
-      options = fetch_options(symbol, d)
-      weeklies.append({
-        'day': d,
-        'options': options,
-      })
-    return weeklies
+    if after:
+        fridays = [d for d in fridays if d.date > after]
+    if workers <= 1:
+        for i, d in enumerate(fridays):
+          print(f'{i+1}/{len(fridays)}...')
+          options = fetch_options(symbol, d, option_bars)
+          yield {
+            'day': d,
+            'options': options,
+          }
+        return
 
-def main():
-    if len(sys.argv) < 2:
-        print('Stock symbol expected as argument', file=sys.stderr)
-        exit(1)
+    # Same requests as above, but batches of weeks are fetched at once by a pool of threads.
+    # parallel_map keeps the order, so the result is identical to the sequential one.
+    for b in range(0, len(fridays), workers):
+        batch = fridays[b:b + workers]
+        print(f'{b + len(batch)}/{len(fridays)}...')
+        contracts = parallel_map(lambda d: list_call_contracts(symbol, d), batch, workers)
+        # contracts not fetched yet, from the first week of the batch they are listed in
+        tasks = {}
+        for d, week_contracts in zip(batch, contracts):
+            for c in week_contracts:
+                if c.ticker not in option_bars:
+                    tasks.setdefault(c.ticker, (d, c))
+        histories = parallel_map(lambda t: list_option_history(t[1], t[0]), tasks.values(), workers)
+        option_bars.update(zip(tasks, histories))
+        for d, week_contracts in zip(batch, contracts):
+            options = [{'contract': c, 'history': history_from(option_bars[c.ticker], d.date)}
+                       for c in week_contracts]
+            print_options(d, options)
+            yield {
+                'day': d,
+                'options': options,
+            }
+
+def update_open_options(data, workers=1):
+    '''Refetches the history of contracts that had not expired when data was fetched, once per contract'''
+    weeklies = data['options_weekly']
+    open_options = [(w['day'], p) for w in weeklies for p in w['options']
+                    if p['contract'].expiration_date >= data['to_date'].isoformat()]
+    first_listed = {}
+    for d, p in open_options:
+        first_listed.setdefault(p['contract'].ticker, (d, p['contract']))
+    print(f'Updating history of {len(first_listed)} open contracts...')
+    histories = parallel_map(lambda t: list_option_history(t[1], t[0]), first_listed.values(), workers)
+    option_bars = dict(zip(first_listed, histories))
+    for d, p in open_options:
+        p['history'] = history_from(option_bars[p['contract'].ticker], d.date)
+    return weeklies
 
-    symbol = sys.argv[1]
+def start_fetch(symbol, log, update=False, workers=1):
+    '''Fetches the stock data of a symbol and writes it in the log, followed by the weeks kept from a previous fetch'''
     ticker_details = client.get_ticker_details(symbol)
     print(f'{symbol} - {ticker_details.name} ({ticker_details.locale}, {ticker_details.type})')
 
     to_date = date.today()
-    # free plan provides only 2y of history
-    from_date = to_date.replace(year=to_date.year - 2)
+    old_data = None
+    if update:
+        try:
+            old_data = load(symbol)
+        except FileNotFoundError:
+            print(f'No saved data for {symbol} - fetching all')
 
-    stock_splits = list_stock_splits(symbol, from_date, to_date)
-    stock_history = list_stock_history(symbol, from_date, to_date)
-    weeklies = fetch_options_weekly(symbol, stock_history)
+    if old_data:
+        from_date = old_data['from_date']
+        old_history = old_data['stock_history']
+        last_day = old_history[-1].date
+        print(f'Updating {symbol} data from {last_day} to {to_date}')
+        stock_splits = list_stock_splits(symbol, from_date, to_date)
+        # the last saved bar may be from during its trading day, so it is fetched again and replaced
+        new_history = list_stock_history(client, symbol, last_day, to_date)
+        stock_history = [a for a in old_history if not new_history or a.date < new_history[0].date] + new_history
+        # and so is a week on or after the day of the previous fetch, with the contracts picked by that bar
+        old_data['options_weekly'] = [w for w in old_data['options_weekly'] if w['day'].date < old_data['to_date']]
+        weeklies = update_open_options(old_data, workers)
+    else:
+        # free plan provides only 2y of history
+        from_date = to_date.replace(year=to_date.year - 2)
+        stock_splits = list_stock_splits(symbol, from_date, to_date)
+        stock_history = list_stock_history(client, symbol, from_date, to_date)
+        weeklies = []
 
-    stock_data = {
+    log.append({
         'symbol': symbol,
         'from_date': from_date,
         'to_date': to_date,
         'ticker_details': ticker_details,
         'stock_splits': stock_splits,
         'stock_history': stock_history,
-        'options_weekly': weeklies,
-    }
-    save(stock_data)
+    })
+    for w in weeklies:
+        log.append(w)
+
+def fetch_chain(symbol, band=0.1, workers=1):
+    '''
+    Saves the complete option chain of each week into the store, instead of one call per expiration.
+    The history of a contract is fetched only the first time it is listed and the bars are stored
+    once per contract and day, so they are shared by all weeks it is listed in.
+    Weeks that are already in the store are skipped, so an interrupted capture can be resumed.
+    '''
+    ticker_details = client.get_ticker_details(symbol)
+    print(f'{symbol} - {ticker_details.name} ({ticker_details.locale}, {ticker_details.type})')
+    to_date = date.today()
+    # free plan provides only 2y of history
+    from_date = to_date.replace(year=to_date.year - 2)
+    stock_splits = list_stock_splits(symbol, from_date, to_date)
+    stock_history = list_stock_history(client, symbol, from_date, to_date)
+
+    store = Store()
+    with store:
+        store.save_underlying(symbol, ticker_details, from_date, to_date)
+        store.save_splits(symbol, stock_splits)
+        store.save_bars(symbol, stock_history)
+
+    captured = store.chain_days(symbol)
+    fridays = select_fridays(stock_history)
+    # contracts of earlier captures that had not expired yet are fetched again from the last captured week
+    last_captured = max((d for d in fridays if d.date.isoformat() in captured),
+                        key=lambda d: d.date, default=None)
+    fetched = set()
+    if last_captured:
+        fetched = store.chain_tickers(symbol, expired_by=last_captured.date)
+        print(f'Skipping {len(captured)} weeks captured before')
+        # all of them, also those that no later week lists because they are out of its band now
+        listed = store.contracts(symbol, expiration_from=last_captured.date + timedelta(days=1),
+                                 contract_type=None, source=CHAIN).drop_duplicates('ticker')
+        open_contracts = [OptionsContract(ticker=t, expiration_date=e.date().isoformat())
+                          for t, e in zip(listed['ticker'], listed['expiration_date'])]
+        histories = parallel_map(lambda c: list_option_history(c, last_captured), open_contracts, workers)
+        with store:
+            for c, h in zip(open_contracts, histories):
+                store.save_bars(c.ticker, h)
+        fetched.update(c.ticker for c in open_contracts)
+        print(f'{len(open_contracts)} contracts of earlier weeks that had not expired fetched again')
+    fridays = [d for d in fridays if d.date.isoformat() not in captured]
+
+    for i, d in enumerate(fridays):
+        contracts = list_chain_contracts(symbol, d, band)
+        new = [c for c in contracts if c.ticker not in fetched]
+        histories = parallel_map(lambda c: list_option_history(c, d), new, workers)
+        with store:
+            store.save_contracts(symbol, d.date, contracts, CHAIN)
+            for c, h in zip(new, histories):
+                store.save_bars(c.ticker, h)
+            store.save_chain_day(symbol, d.date, band)
+        fetched.update(c.ticker for c in new)
+        print(f'{i+1}/{len(fridays)} {d.date}: {len(contracts)} contracts, {len(new)} new, '
+              f'{sum(len(h) for h in histories)} bars')
+    store.close()
+
+def read_log(log):
+    '''
+    Returns the stock data, the day of the last week in the log and the bars of the contracts in it,
+    without keeping all weeks in memory
+    '''
+    records = log.records()
+    stock_data = next(records, None)
+    last_friday = None
+    option_bars = {}
+    for w in records:
+        last_friday = w['day'].date
+        for p in w['options']:
+            option_bars.setdefault(p['contract'].ticker, p['history'])
+    return stock_data, last_friday, option_bars
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('symbol', help='stock symbol')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of concurrent requests (default: 1)')
+    parser.add_argument('--plan', choices=PLAN_RPM.keys(),
+                        help='Polygon plan to take the rate limit from')
+    parser.add_argument('--rpm', type=float,
+                        help='max requests per minute (overrides --plan)')
+    parser.add_argument('--base-url',
+                        help='API base URL, e.g. of a local stub server')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the local response cache')
+    parser.add_argument('--update', action='store_true',
+                        help='extend previously saved data with the new weeks only')
+    parser.add_argument('--chain', action='store_true',
+                        help='capture the whole option chain of each week into the store instead of a file')
+    parser.add_argument('--band', type=float, default=0.1,
+                        help='with --chain, max distance of strike prices from the close price (default: 0.1 = 10%%)')
+    parser.add_argument('--no-store', action='store_true',
+                        help='do not write the data into the local database (store.py)')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    instrument.configure(args)
+    rpm = args.rpm or PLAN_RPM.get(args.plan)
+    cache = None if args.no_cache else ResponseCache()
+    configure(client, base=args.base_url, rpm=rpm, workers=args.workers, cache=cache)
+
+    symbol = args.symbol
+    if args.chain:
+        with instrument.stage('fetch chain'):
+            fetch_chain(symbol, args.band, args.workers)
+        if cache:
+            cache.print_stats()
+        instrument.finish()
+        return
+
+    # weeks are written to the log as they are fetched, so an interrupted fetch resumes where it stopped
+    os.makedirs('data', exist_ok=True)
+    log = ChunkLog(f'data/{symbol}.chunks')
+    stock_data, last_friday, option_bars = read_log(log)
+    if stock_data:
+        print(f'Resuming fetch of {symbol} after {last_friday or "the start"}')
+    else:
+        with instrument.stage('fetch stock data'):
+            start_fetch(symbol, log, args.update, args.workers)
+        stock_data, last_friday, option_bars = read_log(log)
+
+    with instrument.stage('fetch options weekly'):
+        for w in fetch_options_weekly(symbol, stock_data['stock_history'], args.workers,
+                                      after=last_friday, option_bars=option_bars):
+            with instrument.stage('write log'):
+                log.append(w)
 
+    with instrument.stage('save'):
+        records = log.records()
+        stock_data = next(records)
+        stock_data['options_weekly'] = records
+        # the bars of each contract are kept once, the weeks are built again one at a time while saving
+        stock_data = expand(compact(stock_data), lazy=True)
+        save(stock_data)
+    if not args.no_store:
+        with instrument.stage('save store'):
+            Store().save_symbol(stock_data)
+    log.remove()
+    if cache:
+        cache.print_stats()
+    instrument.finish()
 
 if __name__ == "__main__":
     main()
@@ -1,24 +1,508 @@
+import mmap
 import os
 import pickle
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from datetime import date
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # shared modules in the repo root
+from splits import split_factors
+
+# Columnar copy of the data - one Parquet table per kind of record,
+# partitioned by symbol: data/tables/<table>/symbol=<SYMBOL>/data.parquet
+TABLES_DIR = 'data/tables'
+ROW_GROUP_SIZE = 16384  # small row groups let readers skip the dates they filter out
+
+BAR_COLUMNS = {
+    'open': 'float64',
+    'high': 'float64',
+    'low': 'float64',
+    'close': 'float64',
+    'volume': 'float64',
+    'vwap': 'float64',
+    'timestamp': 'int64',
+    'transactions': 'int64',
+}
+
+CONTRACT_COLUMNS = {
+    'ticker': 'string',
+    'contract_type': 'string',
+    'exercise_style': 'string',
+    'expiration_date': 'date32',
+    'strike_price': 'float64',
+    'shares_per_contract': 'int64',
+    'primary_exchange': 'string',
+    'cfi': 'string',
+}
+
+# split_factor converts the prices of a row to the shares after the last split of the data:
+# prices and strikes are multiplied by it and volumes divided by it. Adjusted option volumes count contracts of
+# shares_per_contract shares after the split, so that column is kept and volume * shares * price does not change.
+# Contracts and their bars keep the terms of the day they were listed on.
+TABLE_COLUMNS = {
+    'stock_bars': {'date': 'date32', **BAR_COLUMNS, 'split_factor': 'float64'},
+    # as_of is the day (usually Friday) the contract was listed on
+    'contracts': {'as_of': 'date32', **CONTRACT_COLUMNS, 'split_factor': 'float64'},
+    'option_bars': {'as_of': 'date32', 'ticker': 'string', 'expiration_date': 'date32',
+                    'date': 'date32', **BAR_COLUMNS, 'split_factor': 'float64'},
+}
+
+
+def history_from(bars, day):
+    '''Bars of a contract from day on'''
+    return bars[bisect_left(bars, day, key=lambda a: a.date):]
+
+
+def compact(data):
+    '''
+    Data of a symbol as it is saved: a contract listed in several weeks has its bars once, from the first of them,
+    and each week has only the tickers listed on its day, instead of the contracts and their bars from that day.
+    options_weekly is read once, so it can be an iterator, e.g. over the weeks of a ChunkLog.
+    '''
+    result = {k: v for k, v in data.items() if k != 'options_weekly'}
+    if isinstance(data['options_weekly'], ListedWeeks):  # expanded with lazy=True
+        compacted = data['options_weekly'].data
+        result.update({k: compacted[k] for k in ('contracts', 'option_bars', 'listed')})
+        return result
+    contracts = {}
+    option_bars = {}
+    listed = []
+    for w in data['options_weekly']:
+        for p in w['options']:
+            ticker = p['contract'].ticker
+            if ticker not in contracts:
+                contracts[ticker] = p['contract']
+                option_bars[ticker] = p['history']
+        listed.append({'day': w['day'], 'tickers': [p['contract'].ticker for p in w['options']]})
+    result.update(contracts=contracts, option_bars=option_bars, listed=listed)
+    return result
+
+
+class ListedWeeks(Sequence):
+    '''options_weekly of compact data, each week built when it is read'''
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data['listed'])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        w = self.data['listed'][i]
+        return {
+            'day': w['day'],
+            'options': [{
+                'contract': self.data['contracts'][ticker],
+                'history': history_from(self.data['option_bars'][ticker], w['day'].date),
+            } for ticker in w['tickers']],
+        }
+
+
+def expand(data, lazy=False):
+    '''
+    Data of a symbol with options_weekly, from what compact() returns.
+    With lazy=True, options_weekly builds each week when it is read, so the bars are not copied for all weeks at once.
+    '''
+    if 'options_weekly' in data:  # saved before the data was compacted
+        return data
+    result = {k: v for k, v in data.items() if k not in ('contracts', 'option_bars', 'listed')}
+    weeks = ListedWeeks(data)
+    result['options_weekly'] = weeks if lazy else list(weeks)
+    return result
 
 
 def save(data):
     os.makedirs('data', exist_ok=True)
     file_path = f'data/{data["symbol"]}.pickle'
     with open(file_path, 'wb') as f:
-        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(compact(data), f, protocol=pickle.HIGHEST_PROTOCOL)
     print(f'Data saved in {file_path}')
-    
+    save_weeks(data)
+    save_tables(data)
+
 def load(symbol):
     with open(f'data/{symbol}.pickle', 'rb') as f:
-        return pickle.load(f)
+        return expand(pickle.load(f))
 
 def load_all():
+  '''Loads all symbols at once - see Dataset for loading them on access'''
   map = {}
   for file in os.listdir('data'):
       if not file.endswith('.pickle'):
           continue
       with open(os.path.join('data', file), 'rb') as f:
-          data = pickle.load(f)
+          data = expand(pickle.load(f))
           map[data['symbol']] = data
-  return map
\ No newline at end of file
+  return map
+
+
+def save_weeks(data):
+    '''
+    Saves the weeks of a symbol one after another in data/<SYMBOL>.weeks
+    and the rest of its data with the position of each week in data/<SYMBOL>.index,
+    so a single week can be read without the others.
+    '''
+    symbol = data['symbol']
+    weeks = []
+    with open(f'data/{symbol}.weeks', 'wb') as f:
+        for w in data['options_weekly']:
+            start = f.tell()
+            pickle.dump(w, f, protocol=pickle.HIGHEST_PROTOCOL)
+            weeks.append((w['day'].date, start, f.tell()))
+    # written last, so an index is never newer than its weeks
+    index = {k: v for k, v in data.items() if k != 'options_weekly'}
+    index['weeks'] = weeks
+    with open(f'data/{symbol}.index', 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class Weeks(Sequence):
+    '''options_weekly of a symbol in a Dataset, decoded from the memory-mapped weeks file on access'''
+
+    def __init__(self, dataset, symbol, positions):
+        self.dataset = dataset
+        self.symbol = symbol
+        self.positions = positions
+        self.map = None
+
+    @property
+    def days(self):
+        return [d for d, _, _ in self.positions]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        decoded = self.dataset.decoded.get(self.symbol)
+        if decoded is not None:
+            return decoded[i]
+        _, start, end = self.positions[i]
+        return self.read(start, end)
+
+    def __iter__(self):
+        return iter(self.dataset.decode(self.symbol))
+
+    def read(self, start, end):
+        if self.map is None:
+            with open(f'data/{self.symbol}.weeks', 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return pickle.loads(self.map[start:end])
+
+    def read_all(self):
+        return [self.read(start, end) for _, start, end in self.positions]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class SymbolData(Mapping):
+    '''Data of a symbol like load() returns, but with lazy options_weekly'''
+
+    def __init__(self, dataset, index):
+        self.index = index
+        self.weeks = Weeks(dataset, index['symbol'], index['weeks'])
+
+    def __getitem__(self, key):
+        if key == 'options_weekly':
+            return self.weeks
+        if key == 'weeks':
+            raise KeyError(key)
+        return self.index[key]
+
+    def __iter__(self):
+        yield from (k for k in self.index if k != 'weeks')
+        yield 'options_weekly'
+
+    def __len__(self):
+        return len(self.index)
+
+
+class Dataset(Mapping):
+    '''
+    All symbols saved in data/, like load_all() but read on access.
+    dataset[symbol] reads only the index of a symbol (stock history, splits, details and days of the weeks).
+    Its options_weekly decodes a single week when indexed and all weeks when iterated.
+    All weeks of the last max_symbols iterated symbols are kept in memory.
+    close() unmaps the weeks files, use it as a context manager to close them on exit.
+    '''
+
+    def __init__(self, max_symbols=4):
+        self.max_symbols = max_symbols
+        self.decoded = OrderedDict()
+        self.symbols = {f.removesuffix('.pickle'): None
+                        for f in sorted(os.listdir('data')) if f.endswith('.pickle')}
+
+    def __getitem__(self, symbol):
+        data = self.symbols[symbol]
+        if data is None:
+            data = self.symbols[symbol] = SymbolData(self, self.load_index(symbol))
+        return data
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def meta(self, symbol):
+        '''Everything about a symbol except its weeks'''
+        return {k: v for k, v in self[symbol].index.items() if k != 'weeks'}
+
+    def load_index(self, symbol):
+        index_path = f'data/{symbol}.index'
+        if (not os.path.exists(index_path) or
+                os.path.getmtime(index_path) < os.path.getmtime(f'data/{symbol}.pickle')):
+            print(f'Indexing weeks of {symbol}...')
+            save_weeks(load(symbol))
+        with open(index_path, 'rb') as f:
+            return pickle.load(f)
+
+    def decode(self, symbol):
+        '''Returns all weeks of a symbol, keeping the recently used symbols in memory'''
+        weeks = self.decoded.get(symbol)
+        if weeks is not None:
+            self.decoded.move_to_end(symbol)
+            return weeks
+        weeks = self.decoded[symbol] = self[symbol]['options_weekly'].read_all()
+        while len(self.decoded) > self.max_symbols:
+            self.decoded.popitem(last=False)
+        return weeks
+
+    def close(self):
+        '''Closes the weeks files, a later access opens them again'''
+        for data in self.symbols.values():
+            if data is not None:
+                data.weeks.close()
+        self.decoded.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChunkLog:
+    '''
+    Append-only file of pickled records, e.g. the weeks fetched so far.
+    Each record is on disk once append() returns, so an interrupted fetch loses
+    at most the record being written, which is dropped when the log is read again.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def records(self):
+        if not self.exists():
+            return
+        with open(self.path, 'rb+') as f:
+            while True:
+                offset = f.tell()
+                try:
+                    record = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    if offset < os.path.getsize(self.path):
+                        print(f'WARN: dropping incomplete record at the end of {self.path}')
+                        f.truncate(offset)
+                    return
+                yield record
+
+    def append(self, record):
+        with open(self.path, 'ab') as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        os.remove(self.path)
+
+
+def bar_row(a):
+    return {k: getattr(a, k) for k in BAR_COLUMNS}
+
+
+def to_rows(data):
+    '''
+    Flattens the nested data of a symbol into rows of each table,
+    yielded as a dict of rows per table for the stock bars and then for each week
+    '''
+    # factors of all the stock days at once, relative to the end of the data
+    days = [a.date for a in data['stock_history']]
+    factors = split_factors(data['stock_splits'], days + [data['to_date']])
+    last_factor = factors[-1]
+    yield {'stock_bars': [{'date': a.date, **bar_row(a), 'split_factor': f}
+                          for a, f in zip(data['stock_history'], (factors[:-1] / last_factor).tolist())]}
+    for w in data['options_weekly']:
+        rows = {'contracts': [], 'option_bars': []}
+        as_of = w['day'].date
+        split_factor = float(split_factors(data['stock_splits'], [as_of])[0] / last_factor)
+        for p in w['options']:
+            c = p['contract']
+            expiration_date = date.fromisoformat(c.expiration_date)
+            rows['contracts'].append({
+                'as_of': as_of,
+                **{k: getattr(c, k) for k in CONTRACT_COLUMNS},
+                'expiration_date': expiration_date,
+                'split_factor': split_factor,
+            })
+            for a in p['history']:
+                rows['option_bars'].append({
+                    'as_of': as_of,
+                    'ticker': c.ticker,
+                    'expiration_date': expiration_date,
+                    'date': a.date,
+                    **bar_row(a),
+                    'split_factor': split_factor,
+                })
+        yield rows
+
+
+def save_tables(data):
+    '''
+    Saves data of a symbol in columnar tables, replacing the previous ones of that symbol.
+    The rows are written a row group at a time, so options_weekly can build its weeks when they are read.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    symbol = data['symbol']
+    schemas = {name: pa.schema([(k, getattr(pa, t)()) for k, t in columns.items()])
+               for name, columns in TABLE_COLUMNS.items()}
+    writers = {}
+    for name in TABLE_COLUMNS:
+        dir = f'{TABLES_DIR}/{name}/symbol={symbol}'
+        os.makedirs(dir, exist_ok=True)
+        writers[name] = pq.ParquetWriter(f'{dir}/data.parquet', schemas[name])
+    pending = {name: [] for name in TABLE_COLUMNS}
+
+    def write(name, rows):
+        writers[name].write_table(pa.Table.from_pylist(rows, schema=schemas[name]), row_group_size=ROW_GROUP_SIZE)
+
+    try:
+        for rows in to_rows(data):
+            for name, r in rows.items():
+                pending[name] += r
+                if len(pending[name]) >= ROW_GROUP_SIZE:
+                    # whole row groups only, like a single write of all rows
+                    full = len(pending[name]) // ROW_GROUP_SIZE * ROW_GROUP_SIZE
+                    write(name, pending[name][:full])
+                    pending[name] = pending[name][full:]
+        for name in TABLE_COLUMNS:
+            if pending[name]:
+                write(name, pending[name])
+    finally:
+        for w in writers.values():
+            w.close()
+
+    meta = {k: v for k, v in data.items()
+            if k not in ('stock_history', 'options_weekly')}
+    os.makedirs(f'{TABLES_DIR}/meta', exist_ok=True)
+    with open(f'{TABLES_DIR}/meta/{symbol}.pickle', 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    print(f'Tables saved in {TABLES_DIR}')
+
+
+def load_meta(symbol):
+    '''Returns symbol, from_date, to_date, ticker_details and stock_splits of a symbol'''
+    with open(f'{TABLES_DIR}/meta/{symbol}.pickle', 'rb') as f:
+        return pickle.load(f)
+
+
+def load_table(name, symbols=None, filters=(), columns=None):
+    '''
+    Reads a table as a DataFrame. Only the files of the given symbols are opened
+    and only the row groups that may match filters (pyarrow DNF, e.g. [('date', '>=', d)]) are read.
+    '''
+    import pyarrow.parquet as pq
+
+    filters = list(filters)
+    if symbols:
+        filters.append(('symbol', 'in', list(symbols)))
+    table = pq.read_table(f'{TABLES_DIR}/{name}', columns=columns,
+                          filters=filters or None,
+                          partitioning='hive', memory_map=True)
+    return table.to_pandas(date_as_object=False)
+
+
+def date_filters(column, from_date, to_date):
+    filters = []
+    if from_date:
+        filters.append((column, '>=', from_date))
+    if to_date:
+        filters.append((column, '<=', to_date))
+    return filters
+
+
+PRICE_COLUMNS = ('open', 'high', 'low', 'close', 'vwap')
+
+
+def adjust_splits(df, prices=PRICE_COLUMNS, shares=()):
+    '''Applies the split_factor column of a table to all its rows at once'''
+    if 'split_factor' not in df:
+        print('WARN: tables without split factors, run convert.py to add them')
+        return df
+    factor = df['split_factor']
+    if (factor == 1).all():
+        return df
+    for c in prices:
+        df[c] = df[c] * factor
+    for c in shares:
+        df[c] = df[c] / factor
+    return df
+
+
+def load_stock_bars(symbols=None, from_date=None, to_date=None, adjusted=True):
+    '''Daily bars of the stocks, in the shares after their last split unless adjusted is False'''
+    df = load_table('stock_bars', symbols, date_filters('date', from_date, to_date))
+    return adjust_splits(df, shares=('volume',)) if adjusted else df
+
+
+def exclude_anomalies(df, kinds):
+    '''Rows of df except the ones of contracts (as listed on a day) with any of these kinds of anomalies'''
+    if not kinds or df.empty:
+        return df
+    import pandas as pd
+    from validate import load_anomalies
+
+    # only the symbols left after the filters of the loader
+    anomalies = [load_anomalies(symbol) for symbol in df['symbol'].unique()]
+    bad = [a[a['kind'].isin(list(kinds))] for a in anomalies]
+    bad = [b for b in bad if not b.empty]
+    if not bad:
+        return df
+    bad = pd.MultiIndex.from_frame(pd.concat(bad)[['as_of', 'ticker']])
+    return df[~pd.MultiIndex.from_frame(df[['as_of', 'ticker']]).isin(bad)].reset_index(drop=True)
+
+
+def load_contracts(symbols=None, from_date=None, to_date=None,
+                   expiration_from=None, expiration_to=None, adjusted=True, exclude=()):
+    '''
+    Contracts listed between from_date and to_date which expire between expiration_from and expiration_to,
+    except the ones with the kinds of anomalies in exclude (see validate.KINDS)
+    '''
+    df = load_table('contracts', symbols,
+                    date_filters('as_of', from_date, to_date) +
+                    date_filters('expiration_date', expiration_from, expiration_to))
+    df = exclude_anomalies(df, exclude)
+    return adjust_splits(df, ('strike_price',)) if adjusted else df
+
+
+def load_option_bars(symbols=None, from_date=None, to_date=None,
+                     expiration_from=None, expiration_to=None, adjusted=True, exclude=()):
+    '''Bars of the contracts selected as in load_contracts'''
+    df = load_table('option_bars', symbols,
+                    date_filters('as_of', from_date, to_date) +
+                    date_filters('expiration_date', expiration_from, expiration_to))
+    df = exclude_anomalies(df, exclude)
+    return adjust_splits(df, shares=('volume',)) if adjusted else df
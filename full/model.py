@@ -1,5 +1,17 @@
 
 from datetime import date
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from file import TABLES_DIR, load_contracts, load_meta, load_option_bars, load_stock_bars
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # shared modules in the repo root
+from greeks import RATE, bar_greeks
+from stock import week_ends
+from store import WEEKLY
+import instrument
 
 
 def find_buy_price(start_date, option):
@@ -17,6 +29,7 @@ def find_buy_price(start_date, option):
     return None
 
 
+@instrument.timed()
 def create_transactions(data):
     stock_days = {w['day'].date: w['day'] for w in data['options_weekly']}
     tx = []
@@ -54,4 +67,136 @@ def create_transactions(data):
                 'stock_change_ratio': expiration_day.close / w['day'].close - 1,
             })
     print(f'WARN: {missing_price}/{count} option contracts with missing price data')
-    return tx
\ No newline at end of file
+    return tx
+
+
+TRANSACTION_DTYPES = {
+    'contract': 'object',
+    'strike': 'float64',
+    'buy_price': 'float64',
+    'buy_date': 'datetime64[ms]',
+    'sell_price': 'float64',
+    'sell_date': 'datetime64[ms]',
+    'weeks': 'int64',
+    'profit_ratio': 'float64',
+    'stock_start_price': 'float64',
+    'stock_end_price': 'float64',
+    'stock_change_ratio': 'float64',
+}
+
+
+@instrument.timed()
+def create_transactions_df(contracts, option_bars, stock_bars, to_date):
+    '''
+    Same as create_transactions, but computed over whole arrays and returned as a DataFrame.
+    Takes the tables of a single symbol as returned by file.load_contracts, load_option_bars and load_stock_bars.
+    '''
+    def days(column):
+        return column.to_numpy('datetime64[D]')
+
+    stock_dates = days(stock_bars['date'])
+    weekly = week_ends(stock_dates)
+    stock_days = stock_dates[weekly]
+    stock_close = stock_bars['close'].to_numpy()[weekly]
+
+    buy_date = days(contracts['as_of'])
+    sell_date = days(contracts['expiration_date'])
+    count = len(contracts)
+    selected = (sell_date != buy_date) & (sell_date <= np.datetime64(to_date, 'D'))
+    if option_bars.empty or not len(stock_days):
+        # e.g. a new symbol, or a store with only the bars of the underlying
+        print(f'WARN: {selected.sum()}/{count} option contracts with missing price data')
+        return pd.DataFrame({c: pd.Series(dtype=t) for c, t in TRANSACTION_DTYPES.items()})
+
+    # match each contract with the first bar of its history by (as_of, ticker) key
+    codes, tickers = pd.factorize(pd.concat([contracts['ticker'], option_bars['ticker']], ignore_index=True))
+    def keys(as_of, ticker_codes):
+        return as_of.astype(np.int64) * len(tickers) + ticker_codes
+    contract_keys = keys(buy_date, codes[:count])
+    bar_keys = keys(days(option_bars['as_of']), codes[count:])
+    first = np.append(True, bar_keys[1:] != bar_keys[:-1])  # bars are sorted by key and date
+    first_keys = bar_keys[first]
+    order = np.argsort(first_keys, kind='stable')
+    pos = np.searchsorted(first_keys, contract_keys, sorter=order).clip(max=len(order) - 1)
+    bar = np.flatnonzero(first)[order[pos]] if len(order) else np.zeros(count, int)
+    has_history = first_keys[order[pos]] == contract_keys if len(order) else np.zeros(count, bool)
+
+    first_date = np.where(has_history, days(option_bars['date'])[bar], np.datetime64('NaT'))
+    first_open = option_bars['open'].to_numpy()[bar]
+    first_close = option_bars['close'].to_numpy()[bar]
+
+    for i in np.flatnonzero(selected & (first_date < buy_date)):
+        print(f'WARN: option history for {contracts["ticker"].iloc[i]} starts on {first_date[i]} - before {buy_date[i]}')
+    buy_price = np.where(first_date == buy_date, first_close,
+                         np.where((first_date > buy_date) & (first_date - buy_date <= np.timedelta64(3, 'D')),  # Sat & Sun
+                                  first_open, np.nan))
+    has_price = ~np.isnan(buy_price) & (buy_price != 0)
+    missing_price = (selected & ~has_price).sum()
+    selected &= has_price
+
+    # close price of the week day on which the contract was bought and expired
+    start = np.searchsorted(stock_days, buy_date).clip(max=len(stock_days) - 1)
+    end = np.searchsorted(stock_days, sell_date).clip(max=len(stock_days) - 1)
+    has_stock = stock_days[end] == sell_date
+    for d in sell_date[selected & ~has_stock]:
+        print(f'WARN: no stock data for {d}')
+    selected &= has_stock
+
+    strike = contracts['strike_price'].to_numpy()[selected]
+    buy_price = buy_price[selected]
+    buy_date = buy_date[selected]
+    sell_date = sell_date[selected]
+    stock_start_price = stock_close[start[selected]]
+    stock_end_price = stock_close[end[selected]]
+    sell_price = stock_end_price - strike - buy_price
+    sell_price = np.where(sell_price > 0, sell_price, 0.0)
+    print(f'WARN: {missing_price}/{count} option contracts with missing price data')
+    return pd.DataFrame({
+        'contract': contracts['ticker'].to_numpy()[selected],
+        'strike': strike,
+        'buy_price': buy_price,
+        'buy_date': buy_date.astype('datetime64[ms]'),
+        'sell_price': sell_price,
+        'sell_date': sell_date.astype('datetime64[ms]'),
+        'weeks': np.round((sell_date - buy_date).astype(np.int64) / 7).astype(np.int64),
+        'profit_ratio': sell_price / buy_price - 1,
+        'stock_start_price': stock_start_price,
+        'stock_end_price': stock_end_price,
+        'stock_change_ratio': stock_end_price / stock_start_price - 1,
+    })
+
+
+@instrument.timed()
+def load_transactions(symbol):
+    '''Transactions of a symbol built from its columnar tables, in the prices as they were traded like the pickles'''
+    return create_transactions_df(load_contracts([symbol], adjusted=False),
+                                  load_option_bars([symbol], adjusted=False),
+                                  load_stock_bars([symbol], adjusted=False),
+                                  load_meta(symbol)['to_date'])
+
+
+@instrument.timed()
+def store_transactions(store, symbol):
+    '''Transactions of a symbol built from the local database (store.Store)'''
+    to_date = store.underlyings().set_index('symbol').loc[symbol, 'to_date']
+    # only the contracts full/fetch.py listed, like the tables
+    return create_transactions_df(store.contracts(symbol, source=WEEKLY),
+                                  store.option_bars(symbol, source=WEEKLY),
+                                  store.stock_bars(symbol),
+                                  to_date.date())
+
+
+@instrument.timed()
+def load_greeks(symbol, rate=RATE):
+    '''
+    Implied volatility and greeks of every option bar of a symbol (see greeks.bar_greeks),
+    cached in data/tables/greeks and computed again when the option bars of the symbol are saved again
+    '''
+    path = f'{TABLES_DIR}/greeks/symbol={symbol}/rate={rate}.parquet'
+    if (os.path.exists(path) and
+            os.path.getmtime(path) >= os.path.getmtime(f'{TABLES_DIR}/option_bars/symbol={symbol}/data.parquet')):
+        return pd.read_parquet(path)
+    df = bar_greeks(load_option_bars([symbol]), load_contracts([symbol]), load_stock_bars([symbol]), rate)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path, index=False)
+    return df
@@ -0,0 +1,98 @@
+# Regenerate option_leverage/<SYMBOL>.json (weeks to expiration -> median call leverage) for all saved symbols.
+# Only symbols whose data changed since the last run are computed again, unless they are given as arguments.
+
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from file import load
+
+OUTPUT_DIR = 'option_leverage'
+SOURCES_FILE = f'{OUTPUT_DIR}/sources.json'
+QUANTILES = (0.1, 0.25, 0.75, 0.9)  # and the median
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def changed(path, source):
+    '''Whether a file differs from its recorded source - checks the content only if size or mtime changed'''
+    stat = os.stat(path)
+    if source and (source['size'], source['mtime']) == (stat.st_size, stat.st_mtime):
+        return False
+    return not source or file_hash(path) != source['sha256']
+
+
+def first_prices(data) -> pd.DataFrame:
+    '''Contract and first bar of each option listed in the weekly data'''
+    rows = [(w['day'].date, p['contract'].expiration_date, p['contract'].strike_price,
+             p['history'][0].date, p['history'][0].close)
+            for w in data['options_weekly'] for p in w['options'] if p['history']]
+    df = pd.DataFrame(rows, columns=['day', 'expiration_date', 'strike_price', 'first_date', 'first_close'])
+    for c in ('day', 'expiration_date', 'first_date'):
+        df[c] = pd.to_datetime(df[c])
+    return df
+
+
+def leverage_by_weeks(df) -> pd.DataFrame:
+    '''
+    Quantiles of the leverage of calls bought on the day they are listed,
+    grouped by weeks to expiration. Only contracts expiring on Friday are used.
+    '''
+    weeks = np.round((df['expiration_date'] - df['day']).dt.days / 7).astype(int)
+    selected = ((df['expiration_date'].dt.weekday == 4) & (weeks > 0) &
+                (df['first_date'] == df['day']))
+    leverage = (df['strike_price'] / df['first_close'])[selected]
+    grouped = leverage.groupby(weeks[selected])
+    result = grouped.quantile(list(QUANTILES)).unstack()
+    result.columns = [f'q{round(q * 100)}' for q in QUANTILES]
+    result.insert(0, 'count', grouped.size())
+    result.insert(3, 'median', grouped.median())
+    result.index.name = 'weeks'
+    return result
+
+
+def normalized_medians(result):
+    '''Medians reordered so that longer expirations have lower leverage, as the backtests expect'''
+    return {int(k): float(v) for k, v in zip(sorted(result.index), sorted(result['median'], reverse=True))}
+
+
+def main():
+    symbols = sys.argv[1:] or sorted(f.removesuffix('.pickle')
+                                     for f in os.listdir('data') if f.endswith('.pickle'))
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    sources = {}
+    if os.path.exists(SOURCES_FILE):
+        with open(SOURCES_FILE) as f:
+            sources = json.load(f)
+
+    for symbol in symbols:
+        path = f'data/{symbol}.pickle'
+        if not sys.argv[1:] and not changed(path, sources.get(symbol)):
+            continue
+        data = load(symbol)
+        result = leverage_by_weeks(first_prices(data))
+        leverage = normalized_medians(result)
+        print(f'{symbol}: {len(leverage)} expirations')
+        with open(f'{OUTPUT_DIR}/{symbol}.json', 'w') as json_file:
+            json.dump(leverage, json_file, indent=4, sort_keys=True)
+        result.to_csv(f'{OUTPUT_DIR}/{symbol}.quantiles.csv')
+
+        stat = os.stat(path)
+        sources[symbol] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_hash(path)}
+        with open(SOURCES_FILE, 'w') as f:
+            json.dump(sources, f, indent=4, sort_keys=True)
+
+    print(f'Call leverages saved under {OUTPUT_DIR}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+'''
+Finds anomalies in the option histories of symbols, over all their contracts and bars at once,
+and prints how many contracts of each symbol have each kind of anomaly.
+
+The anomalies of a symbol are cached in data/tables/anomalies (see load_anomalies),
+so file.load_contracts and file.load_option_bars can leave out contracts that have some kinds of them.
+'''
+
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from file import TABLES_DIR, load_contracts, load_option_bars, load_stock_bars
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # shared modules in the repo root
+import instrument
+
+KINDS = {
+    'order': 'bars not in increasing date order',
+    'no_bars': 'no bars at all - no trades?',
+    'early_start': 'first bar before the day the contract was listed on',
+    'late_start': 'first bar after the day the contract was listed on (value: trading days later)',
+    'gap': 'no bars for several trading days (value: trading days without bars)',
+    'early_end': 'last bar before the last trading day of an expired contract (value: trading days earlier)',
+    'after_expiration': 'bars after the expiration date (value: number of bars)',
+    'intrinsic': 'last close far from the intrinsic value at expiration (value: close - intrinsic value)',
+}
+MIN_GAP = 5  # trading days
+# the last close differs from the intrinsic value if both the difference and the ratio are above these
+INTRINSIC_TOLERANCE = 0.20
+INTRINSIC_RATIO_TOLERANCE = 0.20
+
+ANOMALY_COLUMNS = ['as_of', 'ticker', 'kind', 'date', 'value']
+
+
+def anomalies_of(kind, rows, date=None, value=None) -> pd.DataFrame:
+    return pd.DataFrame({
+        'as_of': rows['as_of'].to_numpy(),
+        'ticker': rows['ticker'].to_numpy(),
+        'kind': kind,
+        'date': pd.NaT if date is None else pd.to_datetime(date).to_numpy(),
+        'value': np.nan if value is None else np.asarray(value, dtype=float),
+    })
+
+
+@instrument.timed()
+def find_anomalies(contracts, option_bars, stock_bars) -> pd.DataFrame:
+    '''
+    One row per anomaly of a contract as listed on a day (as_of, ticker), with the date of the bar it was found at
+    and a value depending on its kind (see KINDS). Takes the tables of a single symbol, not split adjusted,
+    as returned by file.load_contracts, load_option_bars and load_stock_bars or by store.Store.
+    '''
+    keys = ['as_of', 'ticker']
+    contracts = contracts.drop_duplicates(keys)
+    days = np.sort(stock_bars['date'].to_numpy('datetime64[D]'))  # trading calendar
+    stock_close = stock_bars.set_index('date')['close']
+    found = []
+
+    # in the order the bars were fetched
+    bars = option_bars[keys + ['date', 'close']].reset_index(drop=True)
+    same = ((bars['as_of'].to_numpy()[1:] == bars['as_of'].to_numpy()[:-1]) &
+            (bars['ticker'].to_numpy()[1:] == bars['ticker'].to_numpy()[:-1]))
+    unordered = np.flatnonzero(same & (bars['date'].to_numpy()[1:] <= bars['date'].to_numpy()[:-1])) + 1
+    found.append(anomalies_of('order', bars.iloc[unordered], bars['date'].iloc[unordered]))
+
+    bars = bars.sort_values(keys + ['date'], kind='stable', ignore_index=True)
+    position = np.searchsorted(days, bars['date'].to_numpy('datetime64[D]'))
+    same = ((bars['as_of'].to_numpy()[1:] == bars['as_of'].to_numpy()[:-1]) &
+            (bars['ticker'].to_numpy()[1:] == bars['ticker'].to_numpy()[:-1]))
+    missing = np.diff(position) - 1
+    gaps = np.flatnonzero(same & (missing >= MIN_GAP)) + 1
+    found.append(anomalies_of('gap', bars.iloc[gaps], bars['date'].iloc[gaps], missing[gaps - 1]))
+
+    grouped = bars.groupby(keys, sort=False)
+    first = grouped.head(1).set_index(keys)
+    last = grouped.tail(1).set_index(keys)
+    c = contracts.set_index(keys)[['contract_type', 'expiration_date', 'strike_price']]
+    c = c.join(first['date'].rename('first_date')).join(last[['date', 'close']].rename(
+        columns={'date': 'last_date', 'close': 'last_close'})).reset_index()
+
+    found.append(anomalies_of('no_bars', c[c['first_date'].isna()]))
+    c = c[c['first_date'].notna()]
+    early = c[c['first_date'] < c['as_of']]
+    found.append(anomalies_of('early_start', early, early['first_date']))
+    late_days = (np.searchsorted(days, c['first_date'].to_numpy('datetime64[D]')) -
+                 np.searchsorted(days, c['as_of'].to_numpy('datetime64[D]')))
+    late = late_days > 0
+    found.append(anomalies_of('late_start', c[late], c['first_date'][late], late_days[late]))
+
+    after = bars.merge(c[keys + ['expiration_date']], on=keys)
+    after = after[after['date'] > after['expiration_date']].groupby(keys, sort=False)['date'].agg(['min', 'size'])
+    found.append(anomalies_of('after_expiration', after.reset_index(), after['min'], after['size']))
+
+    # contracts that expired within the stock history, with their last trading day
+    expiration = c['expiration_date'].to_numpy('datetime64[D]')
+    expired = (expiration <= days[-1]) & (expiration >= days[0]) if len(days) else np.zeros(len(c), dtype=bool)
+    c = c[expired]
+    last_day = days[np.searchsorted(days, expiration[expired], side='right') - 1]
+    early_days = np.searchsorted(days, last_day) - np.searchsorted(days, c['last_date'].to_numpy('datetime64[D]'))
+    early = early_days > 0
+    found.append(anomalies_of('early_end', c[early], c['last_date'][early], early_days[early]))
+
+    on_last_day = ~early
+    c = c[on_last_day]
+    stock = stock_close.reindex(pd.to_datetime(last_day[on_last_day])).to_numpy()
+    intrinsic = np.maximum(np.where(c['contract_type'] == 'put',
+                                    c['strike_price'] - stock, stock - c['strike_price']), 0)
+    difference = c['last_close'].to_numpy() - intrinsic
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mismatch = ((np.abs(difference) > INTRINSIC_TOLERANCE) &
+                    ((intrinsic == 0) | (np.abs(c['last_close'].to_numpy() / intrinsic - 1) > INTRINSIC_RATIO_TOLERANCE)))
+    found.append(anomalies_of('intrinsic', c[mismatch], c['last_date'][mismatch], difference[mismatch]))
+
+    found = [f for f in found if not f.empty]
+    if not found:
+        return pd.DataFrame({k: pd.Series(dtype=t) for k, t in zip(
+            ANOMALY_COLUMNS, ['datetime64[ms]', 'string', 'string', 'datetime64[ms]', 'float64'])})
+    return pd.concat(found, ignore_index=True).sort_values(['as_of', 'ticker', 'kind'], ignore_index=True)
+
+
+def anomalies_path(symbol):
+    return f'{TABLES_DIR}/anomalies/symbol={symbol}/data.parquet'
+
+
+@instrument.timed()
+def load_anomalies(symbol) -> pd.DataFrame:
+    '''find_anomalies of a symbol, cached in data/tables/anomalies and computed again when its option bars are saved again'''
+    path = anomalies_path(symbol)
+    if (os.path.exists(path) and
+            os.path.getmtime(path) >= os.path.getmtime(f'{TABLES_DIR}/option_bars/symbol={symbol}/data.parquet')):
+        return pd.read_parquet(path)
+    print(f'Finding anomalies of {symbol}...')
+    df = find_anomalies(load_contracts([symbol], adjusted=False),
+                        load_option_bars([symbol], adjusted=False),
+                        load_stock_bars([symbol], adjusted=False))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path, index=False)
+    return df
+
+
+def summary(anomalies) -> pd.DataFrame:
+    '''Number of contracts (as listed on a day) with each kind of anomaly'''
+    return anomalies.drop_duplicates(['as_of', 'ticker', 'kind']).groupby('kind').size().reindex(KINDS, fill_value=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('symbols', nargs='*', help='stock symbols (default: all saved symbols)')
+    parser.add_argument('--store', action='store_true', help='check the local database instead of the tables')
+    parser.add_argument('--output', help='save all anomalies to this CSV file')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args)
+
+    symbols = args.symbols or sorted(f.removeprefix('symbol=') for f in os.listdir(f'{TABLES_DIR}/option_bars'))
+    if args.store:
+        import store
+        s = store.Store()
+    results = {}
+    for symbol in symbols:
+        if args.store:
+            results[symbol] = find_anomalies(s.contracts(symbol, contract_type=None, source=store.WEEKLY),
+                                             s.option_bars(symbol, source=store.WEEKLY), s.stock_bars(symbol))
+        else:
+            results[symbol] = load_anomalies(symbol)
+
+    table = pd.DataFrame({symbol: summary(df) for symbol, df in results.items()})
+    with pd.option_context('display.max_columns', None, 'display.width', None):
+        print('Contracts with each kind of anomaly:')
+        print(table.to_string())
+    for kind, description in KINDS.items():
+        print(f'{kind}: {description}')
+    if args.output:
+        pd.concat(results, names=['symbol']).reset_index(level=0).to_csv(args.output, index=False)
+    instrument.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Black-Scholes implied volatility and greeks of many option prices at once
+
+import os
+import numpy as np
+import pandas as pd
+
+RATE = 0.04  # risk free interest rate per year
+MIN_VOLATILITY = 1e-4
+MAX_VOLATILITY = 10.0
+
+
+def norm_pdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2 * np.pi)
+
+
+def norm_cdf(x):
+    '''Standard normal CDF over arrays, from the erfc approximation of Numerical Recipes (error < 1.2e-7)'''
+    z = np.abs(x) / np.sqrt(2)
+    t = 1 / (1 + 0.5 * z)
+    erfc = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 +
+                      t * (-0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 +
+                      t * (-0.82215223 + t * 0.17087277)))))))))
+    return np.where(x >= 0, 1 - 0.5 * erfc, 0.5 * erfc)
+
+
+def d1_d2(spot, strike, years, volatility, rate):
+    vt = volatility * np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * volatility * volatility) * years) / vt
+    return d1, d1 - vt
+
+
+def price(spot, strike, years, volatility, rate=RATE, call=True):
+    '''Black-Scholes price of European options (American calls without dividends are worth the same)'''
+    d1, d2 = d1_d2(spot, strike, years, volatility, rate)
+    discounted_strike = strike * np.exp(-rate * years)
+    call_price = spot * norm_cdf(d1) - discounted_strike * norm_cdf(d2)
+    # put-call parity
+    return np.where(call, call_price, call_price - spot + discounted_strike)
+
+
+def implied_volatility(option_price, spot, strike, years, rate=RATE, call=True,
+                       tolerance=1e-6, max_iterations=100):
+    '''
+    Volatility at which the Black-Scholes price equals option_price, for all options at once.
+    Newton steps are taken while they stay inside a bracket of the solution, bisection steps otherwise,
+    so every option converges, until the price is within tolerance (relative) of option_price.
+    NaN where there is no solution: expired options and prices outside the no-arbitrage bounds,
+    e.g. below the intrinsic value.
+    '''
+    option_price, spot, strike, years, call = np.broadcast_arrays(
+        *(np.asarray(a, dtype=float) for a in (option_price, spot, strike, years)), np.asarray(call, dtype=bool))
+    discounted_strike = strike * np.exp(-rate * np.maximum(years, 0))
+    lower_bound = np.where(call, np.maximum(spot - discounted_strike, 0), np.maximum(discounted_strike - spot, 0))
+    upper_bound = np.where(call, spot, discounted_strike)
+    valid = (years > 0) & (option_price > lower_bound) & (option_price < upper_bound) & (spot > 0) & (strike > 0)
+
+    # solve only the valid ones, so no NaN spreads through the iterations
+    target, s, k, t, c = (a[valid] for a in (option_price, spot, strike, years, call))
+    low = np.full(target.shape, MIN_VOLATILITY)
+    high = np.full(target.shape, MAX_VOLATILITY)
+    volatility = np.full(target.shape, 0.5)
+    active = np.ones(target.shape, dtype=bool)
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        i = np.flatnonzero(active)
+        v = volatility[i]
+        diff = price(s[i], k[i], t[i], v, rate, c[i]) - target[i]
+        d1, _ = d1_d2(s[i], k[i], t[i], v, rate)
+        vega = s[i] * norm_pdf(d1) * np.sqrt(t[i])
+        # the price grows with volatility, so the solution is below v if the price is too high
+        high[i] = np.where(diff > 0, v, high[i])
+        low[i] = np.where(diff > 0, low[i], v)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = v - diff / vega
+        inside = (newton > low[i]) & (newton < high[i])
+        converged = (np.abs(diff) <= tolerance * target[i]) | (high[i] - low[i] <= tolerance)
+        volatility[i] = np.where(converged, v, np.where(inside, newton, (low[i] + high[i]) / 2))
+        active[i] = ~converged
+
+    result = np.full(option_price.shape, np.nan)
+    result[valid] = volatility
+    return result
+
+
+def greeks(spot, strike, years, volatility, rate=RATE, call=True):
+    '''Delta, gamma, theta (per day) and vega (per 1 volatility point, i.e. 0.01) of options'''
+    spot, strike, years, volatility = (np.asarray(a, dtype=float) for a in (spot, strike, years, volatility))
+    with np.errstate(divide='ignore', invalid='ignore'):  # NaN for options without volatility
+        d1, d2 = d1_d2(spot, strike, years, volatility, rate)
+        sqrt_years = np.sqrt(years)
+    pdf = norm_pdf(d1)
+    discounted_strike = strike * np.exp(-rate * years)
+    call_theta = -spot * pdf * volatility / (2 * sqrt_years) - rate * discounted_strike * norm_cdf(d2)
+    return {
+        'delta': np.where(call, norm_cdf(d1), norm_cdf(d1) - 1),
+        'gamma': pdf / (spot * volatility * sqrt_years),
+        'theta': np.where(call, call_theta, call_theta + rate * discounted_strike) / 365,
+        'vega': spot * pdf * sqrt_years / 100,
+    }
+
+
+def option_greeks(option_price, spot, strike, years, rate=RATE, call=True) -> pd.DataFrame:
+    '''Implied volatility and greeks of options given their prices'''
+    iv = implied_volatility(option_price, spot, strike, years, rate, call)
+    return pd.DataFrame({'iv': iv, **greeks(spot, strike, years, iv, rate, call)})
+
+
+def years_between(start, end):
+    return (pd.to_datetime(end) - pd.to_datetime(start)).dt.days.to_numpy() / 365
+
+
+def bar_greeks(option_bars, contracts, stock_bars, rate=RATE) -> pd.DataFrame:
+    '''
+    Implied volatility and greeks of each daily bar of each contract, from its close price
+    and the stock close price of the same day. Bars of a contract listed in several weeks are used once.
+    Takes the tables of a single symbol as returned by full/file.py or store.Store.
+    '''
+    bars = option_bars[['ticker', 'expiration_date', 'date', 'close']].drop_duplicates(['ticker', 'date'])
+    bars = bars.merge(contracts[['ticker', 'strike_price', 'contract_type']].drop_duplicates('ticker'),
+                      on='ticker')
+    bars = bars.merge(stock_bars[['date', 'close']].rename(columns={'close': 'stock_close'}), on='date')
+    bars = bars.sort_values(['ticker', 'date'], ignore_index=True)
+    return pd.concat([bars, option_greeks(bars['close'], bars['stock_close'], bars['strike_price'],
+                                          years_between(bars['date'], bars['expiration_date']),
+                                          rate, bars['contract_type'] == 'call')], axis=1)
+
+
+def history_greeks(history, rate=RATE) -> pd.DataFrame:
+    '''Implied volatility and greeks of the call options of a History on the day they are bought'''
+    df = pd.DataFrame([{
+        'date': c.stock_start_day.date,
+        'ticker': c.ticker,
+        'expiration_date': c.expiration_date,
+        'strike_price': c.strike_price,
+        'buy_price': c.buy_price,
+        'stock_close': c.stock_start_day.close,
+        'leverage': c.leverage,
+    } for w in history.week_data for c in w.call_options])
+    if df.empty:
+        return df
+    return pd.concat([df, option_greeks(df['buy_price'], df['stock_close'], df['strike_price'],
+                                        years_between(df['date'], df['expiration_date']), rate)], axis=1)
+
+
+def load_history_greeks(symbol, rate=RATE) -> pd.DataFrame:
+    '''
+    history_greeks of a saved History, cached in data/<SYMBOL>.greeks-<rate>.parquet
+    next to it and computed again when the History is saved again
+    '''
+    from model import load_history
+
+    path = f'data/{symbol}.greeks-{rate}.parquet'
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(f'data/{symbol}.pickle'):
+        return pd.read_parquet(path)
+    df = history_greeks(load_history(symbol), rate)
+    df.to_parquet(path, index=False)
+    return df
@@ -1,6 +1,5 @@
-import os
+import argparse
 import pickle
-import sys
 import pandas as pd
 from datetime import date
 from itertools import pairwise
@@ -10,36 +9,17 @@ from time import sleep
 from polygon import RESTClient
 from polygon.rest.models import Agg
 
-from model import OptionData, WeekData, History, save_history
+import instrument
+from api import ResponseCache, configure
+from model import OptionData, WeekData, History, RESULT_COLUMNS, save_history, save_results, span_summary
+from splits import SplitAdjustment
+from stock import list_stock_history, select_fridays
+from store import HISTORY, Store
 
 
 client = RESTClient()  # POLYGON_API_KEY environment variable is used
 
 
-def list_stock_history(symbol, from_date, to_date):
-    '''Returns a list with the last trading day of each week (usually Friday)'''
-    aggs = list(client.list_aggs(
-        symbol,
-        1, 'day',
-        from_date, to_date,
-        adjusted=False))
-    for a in aggs:
-        a.date = date.fromtimestamp(a.timestamp/1000)
-    h = list[Agg]()
-    for a, next_a in pairwise(aggs):
-        if a.date >= next_a.date:
-            raise Exception(
-                f'bad stock history order: {a.date} >= {next_a.date}')
-        if a.date.isoweekday() > next_a.date.isoweekday():
-            h.append(a)
-    Friday = 5
-    last_a = aggs[-1]
-    if last_a.date.isoweekday() == Friday:
-        h.append(last_a)
-    print(f'Fetched {len(aggs)} days - {len(h)} weeks')
-    return h
-
-
 def check_option_consistency(contract, option_history, start_day, end_day):
     for p, n in pairwise(option_history):
         if p.date >= n.date:
@@ -77,40 +57,126 @@ def check_option_consistency(contract, option_history, start_day, end_day):
     return True
 
 
-def fetch_call_option(symbol: str, start_day: Agg, end_day: Agg):
-    call_contracts = list(client.list_options_contracts(
+# strikes listed at once for all expirations: symbols with daily expirations have many of them,
+# so only the strikes up to this far above the price are listed (see list_first_call_contracts)
+STRIKE_BAND = 0.05
+
+
+def list_calls(symbol: str, start_day: Agg, end_days: list[Agg], **strikes):
+    return client.list_options_contracts(
         symbol,
         contract_type='call',
-        expiration_date=end_day.date,
+        expiration_date_gte=end_days[0].date,
+        expiration_date_lte=end_days[-1].date,
         as_of=start_day.date,
-        strike_price_gte=start_day.close,
         sort='strike_price',
         order='asc',
-        limit=1000))
-    if len(call_contracts) == 0:
-        # print(f'No call contracts for {symbol} that expire on {end_day.date} as of {start_day.date}')
-        return None
+        limit=1000,
+        **strikes)
 
-    for p, n in pairwise(call_contracts):
-        if p.strike_price >= n.strike_price:
-            raise Exception(
-                f'bad contract order: strike price {p.strike_price} >= {n.strike_price}')
+
+@instrument.timed()
+def list_first_call_contracts(symbol: str, start_day: Agg, end_days: list[Agg]):
+    '''
+    Returns {expiration date: contract} with the first strike price above the current price
+    for each of end_days, listed at once instead of one request per expiration.
+    Only the strikes within STRIKE_BAND above the price are listed for all expirations in between,
+    the ones above it only for the end days without a strike in the band (or without contracts).
+    '''
+    expiration_dates = {d.date.isoformat() for d in end_days}
+    by_expiration = {}
+    for c in list_calls(symbol, start_day, end_days,
+                        strike_price_gte=start_day.close, strike_price_lte=start_day.close * (1 + STRIKE_BAND)):
+        if c.expiration_date in expiration_dates:
+            by_expiration.setdefault(c.expiration_date, []).append(c)
+    missing = [d for d in end_days if d.date.isoformat() not in by_expiration]
+    if missing:
+        missing_dates = {d.date.isoformat() for d in missing}
+        for c in list_calls(symbol, start_day, missing, strike_price_gt=start_day.close * (1 + STRIKE_BAND)):
+            if c.expiration_date in missing_dates:
+                by_expiration.setdefault(c.expiration_date, []).append(c)
+
+    for contracts in by_expiration.values():
+        for p, n in pairwise(contracts):
+            if p.strike_price >= n.strike_price:
+                raise Exception(
+                    f'bad contract order: strike price {p.strike_price} >= {n.strike_price}')
 
     # pick the first strike price above the current price
-    contract = call_contracts[0]
+    return {e: contracts[0] for e, contracts in by_expiration.items()}
+
 
+@instrument.timed()
+def fetch_option_history(contract, start_date: date):
+    '''Returns the history of a contract from start_date until it expires'''
     option_history = list(client.list_aggs(
         contract.ticker,
         1, 'day',
-        start_day.date, end_day.date,
+        start_date, contract.expiration_date,
         adjusted=False))
     for a in option_history:
         a.date = date.fromtimestamp(a.timestamp/1000)
+    return option_history
+
+
+def plan_call_options(symbol: str, stock_history: list[Agg], spans: range):
+    '''
+    Fetches the contracts and their history needed by all spans.
+    Contracts are listed once per start day for all expirations and each contract
+    history is fetched once from the first day it is bought on, to be sliced for the others.
+    '''
+    contracts = []
+    for i, start_day in enumerate(stock_history[:-1]):
+        end_days = stock_history[i + spans[0]:i + spans[-1] + 1]
+        contracts.append(list_first_call_contracts(symbol, start_day, end_days))
+
+    first_start = {}
+    windows = 0
+    for i, start_day in enumerate(stock_history):
+        for span_weeks in spans:
+            if i + span_weeks >= len(stock_history):
+                break
+            windows += 1
+            contract = contracts[i].get(stock_history[i + span_weeks].date.isoformat())
+            if contract:
+                first_start.setdefault(contract.ticker, (contract, start_day.date))
+    histories = {ticker: fetch_option_history(contract, start_date)
+                 for ticker, (contract, start_date) in first_start.items()}
+    print(f'Fetched {len(contracts)} contract lists and {len(histories)} contract histories '
+          f'for {windows} windows')
+    return contracts, histories
+
+
+@instrument.timed()
+def find_call_option(start_contracts, histories, start_day: Agg, end_day: Agg):
+    contract = start_contracts.get(end_day.date.isoformat())
+    if contract is None:
+        # print(f'No call contracts that expire on {end_day.date} as of {start_day.date}')
+        return None
+    option_history = [a for a in histories[contract.ticker]
+                      if start_day.date <= a.date <= end_day.date]
     if not check_option_consistency(contract, option_history, start_day, end_day):
         return None
     return OptionData(contract, option_history, start_day, end_day)
 
 
+def save_to_store(symbol, ticker_details, from_date, to_date,
+                  stock_splits, daily_history, stock_history, contracts, histories):
+    '''Writes the fetched data into the local database, see store.py'''
+    store = Store()
+    with store:
+        store.save_underlying(symbol, ticker_details, from_date, to_date)
+        store.save_splits(symbol, stock_splits)
+        # all days, as full/fetch.py saves them, not only the weeks
+        store.save_bars(symbol, daily_history)
+        for start_day, start_contracts in zip(stock_history, contracts):
+            store.save_contracts(symbol, start_day.date, start_contracts.values(), HISTORY)
+        for ticker, option_history in histories.items():
+            store.save_bars(ticker, option_history)
+    store.close()
+
+
+@instrument.timed()
 def list_stock_splits(symbol, from_date, to_date):
     splits = list(client.list_splits(symbol,
                                      execution_date_gte=from_date,
@@ -123,28 +189,16 @@ def list_stock_splits(symbol, from_date, to_date):
     return splits
 
 
-def fix_splits(stock_splits, start_day: Agg, end_day: Agg):
-    for split in stock_splits:
-        split_date = date.fromisoformat(split.execution_date)
-        if start_day.date < split_date <= end_day.date:
-            q = split.split_to / split.split_from
-            d = Agg(
-                open=end_day.open * q,
-                high=end_day.high * q,
-                low=end_day.low * q,
-                close=end_day.close * q,
-            )
-            d.date = end_day.date
-            end_day = d
-    return end_day
-
-
 def main():
-    if len(sys.argv) < 2:
-        print('Stock symbol expected as argument', file=sys.stderr)
-        exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('symbol', help='stock symbol')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the local response cache')
+    args = parser.parse_args()
+    cache = None if args.no_cache else ResponseCache()
+    configure(client, cache=cache)
 
-    symbol = sys.argv[1]
+    symbol = args.symbol
     ticker_details = client.get_ticker_details(symbol)
     print(f'{symbol} - {ticker_details.name} ({ticker_details.locale}, {ticker_details.type})')
 
@@ -156,23 +210,34 @@ def main():
     print(
         f'Fetching price history for {symbol} from {from_date} to {to_date}...')
     stock_splits = list_stock_splits(symbol, from_date, to_date)
-    stock_history = list_stock_history(symbol, from_date, to_date)
+    daily_history = list_stock_history(client, symbol, from_date, to_date)
+    stock_history = select_fridays(daily_history)
+
+    split_adjustment = SplitAdjustment(stock_splits, stock_history)
 
-    for span_weeks in range(1, 27):  # 1 - 26
+    spans = range(1, 27)  # 1 - 26
+    print(f'\nFetching {symbol} call options...')
+    with instrument.stage('fetch call options'):
+        contracts, histories = plan_call_options(symbol, stock_history, spans)
+    with instrument.stage('save store'):
+        save_to_store(symbol, ticker_details, from_date, to_date,
+                      stock_splits, daily_history, stock_history, contracts, histories)
+
+    # one row per span and start week, for all spans at once
+    rows = []
+    for span_weeks in spans:
         # span_weeks = 3  # option expiration period in weeks
-        print(
-            f'\nFetching {symbol} call options with {span_weeks}w expiration')
-        results = []
         for i in range(0, len(stock_history) - span_weeks):
             start_day = stock_history[i]
-            end_day = stock_history[i + span_weeks]
-            end_day = fix_splits(stock_splits, start_day, end_day)
-            call_option = fetch_call_option(symbol, start_day, end_day)
+            # end day in the shares of the start day if there were splits in between
+            end_day = split_adjustment.day(i, i + span_weeks)
+            call_option = find_call_option(contracts[i], histories, start_day, end_day)
             if call_option is None:
                 continue
             # print(f'from: {start_day.date} {symbol}@${start_day.close} strike@${call_option.strike_price} call@${call_option.buy_price} leverage:x{call_option.leverage:.1f}')
             # print(f'  to: {end_day.date} {symbol}@${end_day.close} {end_day.close-start_day.close:+.2f} ({end_day.close/start_day.close-1:+.2%}) call@${call_option.sell_price} ({call_option.profit_ratio:+.1%})')
-            results.append({
+            rows.append({
+                'span_weeks': span_weeks,
                 'start_date': start_day.date,
                 'end_date': end_day.date,
                 'stock_start_price': start_day.close,
@@ -183,30 +248,31 @@ def main():
                 'call_end_price': call_option.sell_price,
                 'call_max_price': call_option.max_price,
                 'call_daily_tx': call_option.daily_tx,
-                'call_history_length': len(call_option.history),
+                'call_history_length': call_option.history_length,
             })
             # sleep(24)  # do not breach free rate limit of 5r/m
 
-        if len(results) == 0:
+    results = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+    for c in ('start_date', 'end_date', 'call_expiration_date'):
+        results[c] = pd.to_datetime(results[c])
+    save_results(symbol, results, spans)
+
+    summary = span_summary(results)
+    for span_weeks in spans:
+        print(f'\n{symbol} call options with {span_weeks}w expiration')
+        if span_weeks not in summary.index:
             print('No transactions!')
-            os.remove(f'data/{symbol}/{span_weeks}w.csv')
             continue
+        s = summary.loc[span_weeks]
+        print(f'{int(s.transactions)} transactions')
+        print(f'stock median change: {s.stock_median_change:+.1%}')
+        print(f'Call profit - average: {s.mean_call_profit:+.1%} '
+              f'positive: {s.positive_ratio:.1%} '
+              f'daily tx: {s.call_daily_tx:.0f}')
 
-        df = pd.DataFrame(results)
-        os.makedirs(f'data/{symbol}', exist_ok=True)
-        df.to_csv(f'data/{symbol}/{span_weeks}w.csv', index=False)
-
-        stock_median_change = (df.stock_end_price /
-                               df.stock_start_price - 1).median()
-        call_profits = df.call_end_price / df.call_start_price - 1
-        mean_call_profit = call_profits.mean()
-        positive_ratio = (call_profits > 0).mean()
-        call_daily_tx = df.call_daily_tx.median()
-        print(f'{len(df)} transactions')
-        print(f'stock median change: {stock_median_change:+.1%}')
-        print(f'Call profit - average: {mean_call_profit:+.1%} '
-              f'positive: {positive_ratio:.1%} '
-              f'daily tx: {call_daily_tx:.0f}')
+    if cache:
+        cache.print_stats()
+    instrument.finish()
 
 
 if __name__ == "__main__":
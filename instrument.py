@@ -0,0 +1,140 @@
+# Timers and counters of the hot paths of the scripts, reported at the end when enabled.
+# Enable with the --profile options of the scripts that have them, or with environment variables:
+#   PROFILE=1                  print a summary at the end
+#   PROFILE_JSON=<file>        also save timers and counters as JSON
+#   PROFILE_TRACE=<file>       also save a trace that chrome://tracing or Perfetto can open
+# When disabled, timed functions and stages cost one attribute check.
+
+import functools
+import json
+import os
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from time import perf_counter, thread_time
+
+NULL_CONTEXT = nullcontext()
+
+
+class Timer:
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        self.cpu_start = thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.instruments.add_time(self.name, self.start, perf_counter() - self.start,
+                                  thread_time() - self.cpu_start)
+
+
+class Instruments:
+    def __init__(self):
+        self.enabled = False
+        self.json_path = None
+        self.trace_path = None
+        self.lock = threading.Lock()
+        self.timers = {}  # name -> [calls, wall seconds, cpu seconds]
+        self.counters = Counter()
+        self.events = []
+        self.origin = perf_counter()
+
+    def enable(self, json_path=None, trace_path=None):
+        self.enabled = True
+        self.json_path = json_path
+        self.trace_path = trace_path
+
+    def stage(self, name):
+        '''Context manager that times a block'''
+        if not self.enabled:
+            return NULL_CONTEXT
+        return Timer(self, name)
+
+    def timed(self, name=None):
+        '''Decorator that times each call of a function'''
+        def decorator(fn):
+            label = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with Timer(self, label):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    def add_time(self, name, start, wall, cpu=0.0):
+        with self.lock:
+            t = self.timers.setdefault(name, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += wall
+            t[2] += cpu
+            if self.trace_path:
+                self.events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': (start - self.origin) * 1e6,
+                    'dur': wall * 1e6,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                })
+
+    def to_dict(self):
+        return {
+            'timers': {name: {'calls': calls, 'wall': wall, 'cpu': cpu}
+                       for name, (calls, wall, cpu) in self.timers.items()},
+            'counters': dict(self.counters),
+        }
+
+    def print_summary(self):
+        print('\nProfile:')
+        print(f'{"":<32} {"calls":>8} {"wall s":>10} {"cpu s":>10} {"ms/call":>10}')
+        for name, (calls, wall, cpu) in sorted(self.timers.items(), key=lambda t: -t[1][1]):
+            print(f'{name:<32} {calls:>8} {wall:>10.3f} {cpu:>10.3f} {wall / calls * 1000:>10.2f}')
+        for name, value in sorted(self.counters.items()):
+            print(f'{name:<32} {value:>8,}')
+
+    def finish(self):
+        '''Reports everything measured, called at the end of main()'''
+        if not self.enabled:
+            return
+        self.print_summary()
+        if self.json_path:
+            with open(self.json_path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=4)
+            print(f'Profile saved in {self.json_path}')
+        if self.trace_path:
+            with open(self.trace_path, 'w') as f:
+                json.dump({'traceEvents': self.events}, f)
+            print(f'Trace saved in {self.trace_path}')
+
+
+instruments = Instruments()
+stage = instruments.stage
+timed = instruments.timed
+count = instruments.count
+finish = instruments.finish
+
+if os.environ.get('PROFILE') or os.environ.get('PROFILE_JSON') or os.environ.get('PROFILE_TRACE'):
+    instruments.enable(os.environ.get('PROFILE_JSON'), os.environ.get('PROFILE_TRACE'))
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='print time spent in API calls and stages at the end')
+    parser.add_argument('--profile-json', help='save the profile as JSON to this file')
+    parser.add_argument('--profile-trace', help='save a Chrome trace (chrome://tracing) to this file')
+
+
+def configure(args):
+    if args.profile or args.profile_json or args.profile_trace:
+        instruments.enable(args.profile_json, args.profile_trace)
@@ -1,58 +1,122 @@
 import pickle
 import os
+import re
+from bisect import bisect_left
 from itertools import pairwise
 from datetime import date
 from statistics import median
+import numpy as np
+import pandas as pd
 from polygon.rest.models import TickerDetails, OptionsContract, Agg, Split
 
 
 class OptionData:
+    '''
+    A call option bought on stock_start_day and sold on stock_end_day.
+    Keeps only the fields used by the analysis, derived values are computed once.
+    '''
+    __slots__ = ('ticker', 'strike_price', 'expiration_date', 'history_length',
+                 'stock_start_day', 'stock_end_day',
+                 'buy_price', 'sell_price', 'max_price', 'daily_tx', 'profit_ratio', 'leverage')
+
     def __init__(self, contract: OptionsContract, history: list[Agg], stock_start_day: Agg, stock_end_day: Agg):
-        self.contract = contract
-        self.history = history
+        self.ticker = contract.ticker
+        self.strike_price = contract.strike_price
+        self.expiration_date = contract.expiration_date
+        self.history_length = len(history)
         self.stock_start_day = stock_start_day
         self.stock_end_day = stock_end_day
+        self.buy_price = history[0].close if history[0].date == stock_start_day.date else history[0].open
+        # Use the intrinsic value as there might be no recent transactions reflecting the actual price
+        self.sell_price = max(0, stock_end_day.close - self.strike_price)
+        self.max_price = max([a.high for a in history[1:]]) if len(history) > 1 else None
+        self.daily_tx = median([a.transactions for a in history])
+        # a price of 0 must not fail here: the profit is unknown and the leverage sorts after all others
+        self.profit_ratio: float = self.sell_price / self.buy_price - 1 if self.buy_price else np.nan
+        self.leverage: float = self.strike_price / self.buy_price if self.buy_price else np.inf
 
-    @property
-    def strike_price(self):
-        return self.contract.strike_price
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
 
-    @property
-    def expiration_date(self):
-        return self.contract.expiration_date
+    def __setstate__(self, state):
+        if 'contract' in state:
+            # saved before OptionData kept only the used fields
+            self.__init__(**state)
+        else:
+            for k, v in state.items():
+                setattr(self, k, v)
 
-    @property
-    def buy_price(self):
-        return self.history[0].close if self.history[0].date == self.stock_start_day.date else self.history[0].open
+    def __str__(self):
+        return f'{self.strike_price}\t{self.buy_price}\t{self.sell_price}\t({self.profit_ratio:+.0%})'
 
-    @property
-    def sell_price(self):
-        # Return the intrinsic value as there might be no recent transactions reflecting the actual price
-        return max(0, self.stock_end_day.close - self.strike_price)
 
-    @property
-    def max_price(self):
-        return max([a.high for a in self.history[1:]]) if len(self.history) > 1 else None
+def strike_distance(strike, target):
+    return abs(strike - target)
 
-    @property
-    def daily_tx(self):
-        return median([a.transactions for a in self.history])
 
-    @property
-    def profit_ratio(self) -> float:
-        return self.sell_price / self.buy_price - 1
+def lever_distance(lever, target):
+    # same as lever / target if lever > target else target / lever, but works on arrays too
+    return np.maximum(lever / target, target / lever)
 
-    @property
-    def leverage(self) -> float:
-        return self.strike_price / self.buy_price
 
-    def __str__(self):
-        return f'{self.strike_price}\t{self.buy_price}\t{self.sell_price}\t({self.profit_ratio:+.0%})'
+class NearestIndex:
+    '''
+    Values sorted once, to find the nearest one to a target by bisection instead of a scan.
+    Finds the same index as min(range(len(values)), key=lambda i: distance(values[i], target)),
+    including the choice of the first one of equally distant values.
+    distance must grow with the difference between value and target in both directions.
+    '''
+
+    def __init__(self, values: list[float], distance):
+        self.values = np.array(values, dtype=float)
+        self.distance = distance
+        self.order = np.argsort(self.values, kind='stable')
+        self.sorted = self.values[self.order]
+        self.sorted_list = self.sorted.tolist()
+        # the first position of each run of equal values
+        self.run_start = np.maximum.accumulate(
+            np.where(np.append(True, self.sorted[1:] != self.sorted[:-1]), np.arange(len(values)), 0))
+
+    def find(self, target: float) -> int:
+        right = self.run_start[min(bisect_left(self.sorted_list, target), len(self.sorted_list) - 1)]
+        left = self.run_start[max(right - 1, 0)]
+        left_index = self.order[left]
+        right_index = self.order[right]
+        left_distance = self.distance(self.sorted_list[left], target)
+        right_distance = self.distance(self.sorted_list[right], target)
+        if left_distance < right_distance or (left_distance == right_distance and left_index < right_index):
+            return int(left_index)
+        return int(right_index)
+
+    def find_all(self, targets) -> np.ndarray:
+        '''Same as find() for each of targets, computed over arrays'''
+        targets = np.asarray(targets, dtype=float)
+        right = self.run_start[np.searchsorted(self.sorted, targets).clip(max=len(self.sorted) - 1)]
+        left = self.run_start[(right - 1).clip(min=0)]
+        left_index = self.order[left]
+        right_index = self.order[right]
+        left_distance = self.distance(self.sorted[left], targets)
+        right_distance = self.distance(self.sorted[right], targets)
+        return np.where((left_distance < right_distance) |
+                        ((left_distance == right_distance) & (left_index < right_index)),
+                        left_index, right_index)
+
 
 class WeekData:
+    __slots__ = ('stock', 'call_options', '_strike_index', '_lever_index')
+
     def __init__(self, stock: Agg, call_options: list[OptionData]):
         self.stock = stock
         self.call_options = call_options
+        self._strike_index = None
+        self._lever_index = None
+
+    def __getstate__(self):
+        # do not save the indexes
+        return {'stock': self.stock, 'call_options': self.call_options}
+
+    def __setstate__(self, state):
+        self.__init__(state['stock'], state['call_options'])
 
     def print(self):
         print(self.stock.date, self.stock.close)
@@ -77,12 +141,31 @@ class WeekData:
                    for a, b in pairwise(self.stock.prev.close,
                                         *(c.strike_price for c in self.call_options)))
 
+    # The indexes are built on first use and assume call_options do not change after that
+
+    @property
+    def strike_index(self) -> NearestIndex:
+        if self._strike_index is None:
+            self._strike_index = NearestIndex([c.strike_price for c in self.call_options], strike_distance)
+        return self._strike_index
+
+    @property
+    def lever_index(self) -> NearestIndex:
+        if self._lever_index is None:
+            self._lever_index = NearestIndex([c.leverage for c in self.call_options], lever_distance)
+        return self._lever_index
+
     def find_strike(self, strike: float):
-        return min(self.call_options, key=lambda c: abs(c.strike_price-strike))
+        return self.call_options[self.strike_index.find(strike)]
 
     def find_lever(self, lever: float):
-        return min(self.call_options,
-                   key=lambda c: c.leverage / lever if c.leverage > lever else lever / c.leverage)
+        return self.call_options[self.lever_index.find(lever)]
+
+    def find_strikes(self, strikes) -> list[OptionData]:
+        return [self.call_options[i] for i in self.strike_index.find_all(strikes)]
+
+    def find_levers(self, levers) -> list[OptionData]:
+        return [self.call_options[i] for i in self.lever_index.find_all(levers)]
 
 
 class History:
@@ -130,3 +213,66 @@ def save_history(h: History):
     with open(file_path, 'wb') as f:
         pickle.dump(h, f, protocol=pickle.HIGHEST_PROTOCOL)
     print(f'History saved in {file_path}')
+
+
+# results of history.py: the call bought each week for each span (weeks to expiration)
+RESULT_COLUMNS = [
+    'span_weeks', 'start_date', 'end_date', 'stock_start_price', 'stock_end_price',
+    'call_expiration_date', 'call_strike_price', 'call_start_price', 'call_end_price',
+    'call_max_price', 'call_daily_tx', 'call_history_length',
+]
+
+
+def save_results(symbol, results: pd.DataFrame, spans):
+    '''
+    Replaces the results of the given spans (also the ones without transactions) and keeps those of the other spans.
+    The CSV files of the given spans saved by earlier versions are removed, like they were replaced before.
+    '''
+    os.makedirs('data', exist_ok=True)
+    file_path = f'data/{symbol}.results.parquet'
+    previous = load_results(symbol)
+    results = pd.concat([previous[~previous['span_weeks'].isin(spans)], results]) if len(previous) else results
+    results.sort_values(['span_weeks', 'start_date'], ignore_index=True).to_parquet(file_path, index=False)
+    for span_weeks in spans:
+        csv_path = f'data/{symbol}/{span_weeks}w.csv'
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+    print(f'Results saved in {file_path}')
+
+
+def load_results(symbol) -> pd.DataFrame:
+    '''
+    Results of history.py for all spans in one table. Spans saved before they were in one file
+    are read from their CSV file in data/<SYMBOL>/.
+    '''
+    file_path = f'data/{symbol}.results.parquet'
+    tables = [pd.read_parquet(file_path)] if os.path.exists(file_path) else []
+    saved = set(tables[0]['span_weeks']) if tables else set()
+    csv_dir = f'data/{symbol}'
+    for f in os.listdir(csv_dir) if os.path.isdir(csv_dir) else []:
+        m = re.fullmatch(r'(\d+)w\.csv', f)
+        if m and int(m[1]) not in saved:
+            df = pd.read_csv(f'{csv_dir}/{f}', parse_dates=['start_date', 'end_date', 'call_expiration_date'])
+            df.insert(0, 'span_weeks', int(m[1]))
+            tables.append(df)
+    if not tables:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return pd.concat(tables).sort_values(['span_weeks', 'start_date'], ignore_index=True)
+
+
+def span_summary(results: pd.DataFrame) -> pd.DataFrame:
+    '''Transactions, median stock change, average call profit, ratio of profitable calls and median daily trades of each span'''
+    call_profit = results.call_end_price / results.call_start_price - 1
+    return pd.DataFrame({
+        'span_weeks': results.span_weeks,
+        'stock_change': results.stock_end_price / results.stock_start_price - 1,
+        'call_profit': call_profit,
+        'positive': call_profit > 0,
+        'call_daily_tx': results.call_daily_tx,
+    }).groupby('span_weeks').agg(
+        transactions=('call_profit', 'size'),
+        stock_median_change=('stock_change', 'median'),
+        mean_call_profit=('call_profit', 'mean'),
+        positive_ratio=('positive', 'mean'),
+        call_daily_tx=('call_daily_tx', 'median'),
+    )
@@ -0,0 +1,45 @@
+# Stock split adjustment computed once per symbol, instead of scanning the splits for each window
+
+import numpy as np
+from polygon.rest.models import Agg
+
+
+def split_factors(splits, days) -> np.ndarray:
+    '''
+    Cumulative ratio (split_to / split_from) of the splits executed on or before each of days.
+    A price of one day times factor(later day) / factor(that day) is in the shares of the later day.
+    '''
+    days = np.asarray(days, dtype='datetime64[D]')
+    splits = sorted(splits, key=lambda s: s.execution_date)
+    dates = np.array([s.execution_date for s in splits], dtype='datetime64[D]')
+    cumulative = np.cumprod([1.0] + [s.split_to / s.split_from for s in splits])
+    return cumulative[np.searchsorted(dates, days, side='right')]
+
+
+class SplitAdjustment:
+    '''Split factors of a stock history, to compare the prices of any two of its days'''
+
+    def __init__(self, splits, history: list[Agg]):
+        self.history = history
+        self.factors = split_factors(splits, [a.date for a in history])
+        self.adjusted = {}
+
+    def day(self, start: int, end: int) -> Agg:
+        '''
+        The end day of the history in the prices of the start day (before the splits between them).
+        Days without splits in between are returned as they are and adjusted days are created once.
+        '''
+        q = self.factors[end] / self.factors[start]
+        if q == 1:
+            return self.history[end]
+        d = self.adjusted.get((end, q))
+        if d is None:
+            a = self.history[end]
+            d = self.adjusted[end, q] = Agg(
+                open=a.open * q,
+                high=a.high * q,
+                low=a.low * q,
+                close=a.close * q,
+            )
+            d.date = a.date
+        return d
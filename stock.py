@@ -0,0 +1,169 @@
+# Daily bars of the underlying stocks and the trading calendar derived from them.
+# The bars of each symbol are kept in cache/bars/<SYMBOL>.bars, fixed size records that are only appended to,
+# so a run fetches only the days after the last one saved and any date range is then read without network access.
+
+import json
+import os
+import re
+import numpy as np
+from polygon.rest.models import Agg
+
+import instrument
+
+BARS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'bars')
+POLYGON_BASE = 'https://api.polygon.io'
+
+RECORD = np.dtype([
+    ('timestamp', '<i8'),
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+    ('vwap', '<f8'),
+    ('transactions', '<i8'),
+])
+NO_TRANSACTIONS = -1  # vwap is NaN when missing
+
+
+def to_days(timestamps) -> np.ndarray:
+    '''Trading days of bar timestamps (ms, the start of the day in New York, which is the same day in UTC)'''
+    return np.asarray(timestamps, dtype='datetime64[ms]').astype('datetime64[D]')
+
+
+def week_ends(days) -> np.ndarray:
+    '''Mask of the last trading day of each week in a sorted array of days, the last one only if it is a Friday'''
+    weekday = (days.astype('datetime64[D]').astype(np.int64) + 3) % 7  # Monday is 0
+    Friday = 4
+    return np.append(weekday[:-1] > weekday[1:], weekday[-1:] == Friday)
+
+
+def to_records(aggs) -> np.ndarray:
+    return np.array([(a.timestamp, a.open, a.high, a.low, a.close, a.volume,
+                      np.nan if a.vwap is None else a.vwap,
+                      NO_TRANSACTIONS if a.transactions is None else a.transactions)
+                     for a in aggs], dtype=RECORD)
+
+
+def to_aggs(records) -> list[Agg]:
+    '''Agg objects with a date, as the Polygon client returns them'''
+    aggs = []
+    for r, day in zip(records.tolist(), to_days(records['timestamp']).tolist()):
+        timestamp, open, high, low, close, volume, vwap, transactions = r
+        a = Agg(open=open, high=high, low=low, close=close, volume=volume,
+                vwap=None if vwap != vwap else vwap,
+                timestamp=timestamp,
+                transactions=None if transactions == NO_TRANSACTIONS else transactions,
+                otc=None)
+        a.date = day
+        aggs.append(a)
+    return aggs
+
+
+class BarFile:
+    '''
+    The saved bars of a symbol and the dates they cover, in <SYMBOL>.range next to them
+    (there are no bars for weekends and holidays, so the bars alone do not tell what was fetched).
+    '''
+
+    def __init__(self, symbol, dir=BARS_DIR):
+        self.path = os.path.join(dir, f'{symbol}.bars')
+        self.range_path = os.path.join(dir, f'{symbol}.range')
+
+    def covered(self):
+        '''First and last date of the saved bars, or None'''
+        if not os.path.exists(self.range_path) or not os.path.exists(self.path):
+            return None
+        with open(self.range_path) as f:
+            r = json.load(f)
+        return np.datetime64(r['from_date']), np.datetime64(r['to_date'])
+
+    @instrument.timed('BarFile.read')
+    def read(self) -> np.ndarray:
+        '''Saved bars within the covered range - an interrupted append may have written more'''
+        covered = self.covered()
+        if not covered:
+            return np.empty(0, dtype=RECORD)
+        records = np.fromfile(self.path, dtype=RECORD, count=os.path.getsize(self.path) // RECORD.itemsize)
+        return records[:np.searchsorted(to_days(records['timestamp']), covered[1], side='right')]
+
+    def write(self, records, from_date, to_date, append=False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if append:
+            # drop what an interrupted append left after the covered range
+            size = len(self.read()) * RECORD.itemsize
+            if os.path.getsize(self.path) != size:
+                print(f'WARN: {self.path} has unsaved bars at the end, removing them')
+                os.truncate(self.path, size)
+        with open(self.path, 'ab' if append else 'wb') as f:
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        tmp = self.range_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'from_date': str(from_date), 'to_date': str(to_date)}, f)
+        os.replace(tmp, self.range_path)
+
+
+def bars_dir(client):
+    '''BARS_DIR for the bars of Polygon, a directory in it for those of any other base URL, e.g. a local stub server'''
+    base = getattr(client, 'BASE', POLYGON_BASE)
+    if base == POLYGON_BASE:
+        return BARS_DIR
+    return os.path.join(BARS_DIR, re.sub(r'[^\w.-]+', '_', base.split('://')[-1]))
+
+
+@instrument.timed()
+def fetch_bars(client, symbol, from_date, to_date) -> np.ndarray:
+    return to_records(client.list_aggs(symbol, 1, 'day', str(from_date), str(to_date), adjusted=False))
+
+
+def list_stock_history(client, symbol, from_date, to_date, offline=False) -> list[Agg]:
+    '''
+    Daily bars (not split adjusted) of a stock from from_date to to_date, as Agg objects with a date.
+    Only the days missing from the saved bars are fetched, or none when offline.
+    The bars of today are not saved, since they may not be final yet.
+    A client configured without a response cache (api.configure) fetches all days and does not save them.
+    '''
+    from_date, to_date = np.datetime64(from_date, 'D'), np.datetime64(to_date, 'D')
+    file = BarFile(symbol, bars_dir(client))
+    covered = file.covered()
+    records = file.read()
+    fetched = 0
+    if not offline and getattr(client, 'cache', True) is None:
+        records = fetch_bars(client, symbol, from_date, to_date)
+        fetched = len(records)
+    elif not offline:
+        last_final = min(to_date, np.datetime64('today', 'D') - 1)
+        if not covered or from_date < covered[0]:
+            # the file can only grow at the end, so an earlier start means fetching everything again
+            records = fetch_bars(client, symbol, from_date, to_date)
+            fetched = len(records)
+            file.write(records[to_days(records['timestamp']) <= last_final], from_date, last_final)
+        elif to_date > covered[1]:
+            new = fetch_bars(client, symbol, covered[1] + 1, to_date)
+            fetched = len(new)
+            if last_final > covered[1]:
+                file.write(new[to_days(new['timestamp']) <= last_final], covered[0], last_final, append=True)
+            records = np.concatenate([records, new])
+    elif not covered or from_date < covered[0] or to_date > covered[1]:
+        print(f'WARN: saved {symbol} bars cover {covered and f"{covered[0]} - {covered[1]}"}, '
+              f'not all of {from_date} - {to_date}')
+
+    days = to_days(records['timestamp'])
+    if (days[1:] <= days[:-1]).any():
+        raise Exception(f'bad stock history order in {file.path}')
+    records = records[np.searchsorted(days, from_date):np.searchsorted(days, to_date, side='right')]
+    instrument.count('stock days fetched', fetched)
+    print(f'Stock history for {len(records)} days ({fetched} fetched)')
+    return to_aggs(records)
+
+
+def select_fridays(aggs: list[Agg]) -> list[Agg]:
+    '''The last trading day of each week (usually Friday)'''
+    if not aggs:
+        return []
+    mask = week_ends(np.array([a.date for a in aggs], dtype='datetime64[D]'))
+    h = [a for a, m in zip(aggs, mask.tolist()) if m]
+    print(f'Found {len(h)} weeks')
+    return h
@@ -0,0 +1,247 @@
+# Local database of fetched data, queried with SQL instead of loading whole pickles
+
+import os
+import sqlite3
+from datetime import date
+
+import pandas as pd
+
+STORE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'store', 'options.sqlite')
+
+# what listed the contracts: full/fetch.py (weekly calls), full/fetch.py --chain or history.py (calls by strike)
+WEEKLY, CHAIN, HISTORY = 'weekly', 'chain', 'history'
+
+BAR_COLUMNS = ('open', 'high', 'low', 'close', 'volume', 'vwap', 'timestamp', 'transactions')
+# all but the source, so a contract listed by several sources is returned once
+CONTRACT_COLUMNS = ('as_of', 'ticker', 'underlying', 'contract_type', 'exercise_style',
+                    'expiration_date', 'strike_price', 'shares_per_contract')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS underlying (
+    symbol TEXT PRIMARY KEY,
+    name TEXT,
+    locale TEXT,
+    type TEXT,
+    from_date TEXT,
+    to_date TEXT);
+
+CREATE TABLE IF NOT EXISTS split (
+    symbol TEXT NOT NULL,
+    execution_date TEXT NOT NULL,
+    split_from REAL NOT NULL,
+    split_to REAL NOT NULL,
+    PRIMARY KEY (symbol, execution_date));
+
+-- a contract as listed on a day (as_of), usually a Friday, by one of the sources
+CREATE TABLE IF NOT EXISTS contract (
+    as_of TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    source TEXT NOT NULL,
+    underlying TEXT NOT NULL,
+    contract_type TEXT,
+    exercise_style TEXT,
+    expiration_date TEXT NOT NULL,
+    strike_price REAL NOT NULL,
+    shares_per_contract INTEGER,
+    PRIMARY KEY (as_of, ticker, source));
+CREATE INDEX IF NOT EXISTS contract_lookup
+    ON contract (underlying, source, as_of, expiration_date, strike_price);
+
+-- daily bars of stocks and option contracts
+CREATE TABLE IF NOT EXISTS bar (
+    ticker TEXT NOT NULL,
+    date TEXT NOT NULL,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    volume REAL,
+    vwap REAL,
+    timestamp INTEGER,
+    transactions INTEGER,
+    PRIMARY KEY (ticker, date)) WITHOUT ROWID;
+
+-- days on which the whole option chain was captured (full/fetch.py --chain)
+CREATE TABLE IF NOT EXISTS chain (
+    underlying TEXT NOT NULL,
+    as_of TEXT NOT NULL,
+    band REAL NOT NULL,
+    PRIMARY KEY (underlying, as_of));
+'''
+
+
+def day(d):
+    return d.isoformat() if isinstance(d, date) else d
+
+
+def where(conditions):
+    '''SQL condition and parameters of the (sql, value) pairs whose value is not None'''
+    conditions = [(sql, day(value)) for sql, value in conditions if value is not None]
+    return ' AND '.join(['1'] + [sql for sql, _ in conditions]), [v for _, v in conditions]
+
+
+class Store:
+    '''
+    SQLite database with the underlyings, splits, contracts and daily bars written by
+    full/fetch.py and history.py. Writes are committed when a `with store:` block ends.
+    Queries return DataFrames with the columns of the full/file.py tables, dates as datetime64.
+    '''
+
+    def __init__(self, path=STORE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        columns = [c for _, c, *_ in self.db.execute('PRAGMA table_info(contract)')]
+        if columns and 'source' not in columns:
+            self.add_contract_source()
+        self.db.executescript(SCHEMA)
+
+    def add_contract_source(self):
+        '''Moves the contracts of a store created before they had a source, which is not known for them'''
+        print(f'WARN: contracts in {self.path} have no source, run the scripts again to store them by source')
+        with self.db:
+            self.db.execute('DROP INDEX contract_lookup')
+            self.db.execute('ALTER TABLE contract RENAME TO contract_before_source')
+            self.db.executescript(SCHEMA)
+            self.db.execute('''
+                INSERT INTO contract
+                SELECT as_of, ticker, 'unknown', underlying, contract_type, exercise_style,
+                       expiration_date, strike_price, shares_per_contract
+                FROM contract_before_source''')
+            self.db.execute('DROP TABLE contract_before_source')
+
+    def __enter__(self):
+        self.db.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.db.__exit__(*exc)
+
+    def close(self):
+        self.db.close()
+
+    # writing
+
+    def save_underlying(self, symbol, ticker_details, from_date, to_date):
+        self.db.execute('INSERT OR REPLACE INTO underlying VALUES (?, ?, ?, ?, ?, ?)',
+                        (symbol, *(getattr(ticker_details, k, None) for k in ('name', 'locale', 'type')),
+                         day(from_date), day(to_date)))
+
+    def save_splits(self, symbol, splits):
+        self.db.executemany('INSERT OR REPLACE INTO split VALUES (?, ?, ?, ?)',
+                            [(symbol, s.execution_date, s.split_from, s.split_to) for s in splits])
+
+    def save_contracts(self, symbol, as_of, contracts, source):
+        self.db.executemany('INSERT OR REPLACE INTO contract VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            [(day(as_of), c.ticker, source, symbol, c.contract_type, c.exercise_style,
+                              c.expiration_date, c.strike_price, c.shares_per_contract)
+                             for c in contracts])
+
+    def save_bars(self, ticker, aggs):
+        '''Saves aggregates with a date attribute, as the scripts add them'''
+        self.db.executemany(f'INSERT OR REPLACE INTO bar VALUES (?, ?, {", ".join("?" * len(BAR_COLUMNS))})',
+                            [(ticker, a.date.isoformat(), *(getattr(a, k) for k in BAR_COLUMNS))
+                             for a in aggs])
+
+    def save_symbol(self, data):
+        '''Saves all data of a symbol as full/fetch.py returns it'''
+        symbol = data['symbol']
+        with self:
+            self.save_underlying(symbol, data['ticker_details'], data['from_date'], data['to_date'])
+            self.save_splits(symbol, data['stock_splits'])
+            self.save_bars(symbol, data['stock_history'])
+            for w in data['options_weekly']:
+                self.save_contracts(symbol, w['day'].date, [p['contract'] for p in w['options']], WEEKLY)
+                for p in w['options']:
+                    self.save_bars(p['contract'].ticker, p['history'])
+        print(f'Data saved in {self.path}')
+
+    def save_chain_day(self, symbol, as_of, band):
+        self.db.execute('INSERT OR REPLACE INTO chain VALUES (?, ?, ?)', (symbol, day(as_of), band))
+
+    # querying
+
+    def chain_days(self, symbol):
+        '''ISO dates on which the option chain of a symbol was captured'''
+        return {d for d, in self.db.execute('SELECT as_of FROM chain WHERE underlying = ?', (symbol,))}
+
+    def chain_tickers(self, symbol, expired_by=None):
+        '''Contracts of the captured chains, only those that expired by the given day if it is given'''
+        sql, params = where([('c.expiration_date <= ?', expired_by)])
+        return {t for t, in self.db.execute(f'''
+            SELECT DISTINCT c.ticker FROM contract c JOIN chain USING (underlying, as_of)
+            WHERE c.underlying = ? AND c.source = ? AND {sql}''', [symbol, CHAIN, *params])}
+
+    def query(self, sql, params=(), dates=()):
+        df = pd.read_sql_query(sql, self.db, params=list(params))
+        for column in dates:
+            df[column] = pd.to_datetime(df[column]).astype('datetime64[ms]')
+        return df
+
+    def underlyings(self):
+        return self.query('SELECT * FROM underlying ORDER BY symbol', dates=('from_date', 'to_date'))
+
+    def splits(self, symbol):
+        return self.query('SELECT * FROM split WHERE symbol = ? ORDER BY execution_date', [symbol],
+                          dates=('execution_date',))
+
+    def bars(self, ticker, from_date=None, to_date=None):
+        sql, params = where([('date >= ?', from_date), ('date <= ?', to_date)])
+        return self.query(f'SELECT * FROM bar WHERE ticker = ? AND {sql} ORDER BY date',
+                          [ticker, *params], dates=('date',))
+
+    def stock_bars(self, symbol, from_date=None, to_date=None):
+        return self.bars(symbol, from_date, to_date)
+
+    def contracts(self, symbol, from_date=None, to_date=None,
+                  expiration_from=None, expiration_to=None,
+                  strike_from=None, strike_to=None, contract_type='call', source=None):
+        '''
+        Contracts listed between from_date and to_date which expire between expiration_from and expiration_to.
+        Pass contract_type=None for both calls and puts, and a source (e.g. WEEKLY) for the contracts of one of them.
+        Without a source, a contract listed on the same day by several sources is returned once.
+        '''
+        sql, params = where([('source = ?', source), ('as_of >= ?', from_date), ('as_of <= ?', to_date),
+                             ('expiration_date >= ?', expiration_from), ('expiration_date <= ?', expiration_to),
+                             ('strike_price >= ?', strike_from), ('strike_price <= ?', strike_to),
+                             ('contract_type = ?', contract_type)])
+        return self.query(f'SELECT DISTINCT {", ".join(CONTRACT_COLUMNS)} FROM contract '
+                          f'WHERE underlying = ? AND {sql} ORDER BY as_of, ticker', [symbol, *params],
+                          dates=('as_of', 'expiration_date'))
+
+    def option_bars(self, symbol, from_date=None, to_date=None,
+                    expiration_from=None, expiration_to=None, source=None):
+        '''Bars of the contracts selected as in contracts() from the day they were listed on'''
+        sql, params = where([('c.source = ?', source), ('c.as_of >= ?', from_date), ('c.as_of <= ?', to_date),
+                             ('c.expiration_date >= ?', expiration_from),
+                             ('c.expiration_date <= ?', expiration_to)])
+        return self.query(f'''
+            SELECT DISTINCT c.as_of, c.ticker, c.expiration_date, b.date, {", ".join(f"b.{k}" for k in BAR_COLUMNS)}
+            FROM contract c JOIN bar b ON b.ticker = c.ticker AND b.date >= c.as_of
+            WHERE c.underlying = ? AND {sql}
+            ORDER BY c.as_of, c.ticker, b.date''', [symbol, *params],
+            dates=('as_of', 'expiration_date', 'date'))
+
+    def otm_calls(self, symbol, min_gap, max_gap, weeks=None, from_date=None, to_date=None, source=None):
+        '''
+        Calls with strike between (1 + min_gap) and (1 + max_gap) times the stock close on the day
+        they were listed on, optionally only those expiring in the given number of weeks
+        (rounded, so expirations moved a day by a holiday count too),
+        with the first bar of each contract from that day.
+        '''
+        sql, params = where([('c.source = ?', source), ('c.as_of >= ?', from_date), ('c.as_of <= ?', to_date),
+                             ('CAST(ROUND((julianday(c.expiration_date) - julianday(c.as_of)) / 7) AS INT) = ?',
+                              weeks)])
+        return self.query(f'''
+            SELECT DISTINCT {", ".join(f"c.{k}" for k in CONTRACT_COLUMNS)},
+                   s.close AS stock_close, c.strike_price / s.close - 1 AS strike_gap,
+                   o.date AS option_date, o.open AS option_open, o.close AS option_close
+            FROM contract c
+            JOIN bar s ON s.ticker = c.underlying AND s.date = c.as_of
+            LEFT JOIN bar o ON o.ticker = c.ticker AND o.date = (
+                SELECT MIN(date) FROM bar WHERE ticker = c.ticker AND date >= c.as_of)
+            WHERE c.underlying = ? AND c.contract_type = 'call' AND {sql}
+              AND c.strike_price BETWEEN s.close * (1 + ?) AND s.close * (1 + ?)
+            ORDER BY c.as_of, c.expiration_date, c.strike_price''',
+            [symbol, *params, min_gap, max_gap],
+            dates=('as_of', 'expiration_date', 'option_date'))
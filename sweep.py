@@ -0,0 +1,114 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+
+from model import History, WeekData, load_history
+
+
+class WeekArrays:
+    '''Arrays of the call options of a week used by the sweeps'''
+
+    def __init__(self, week: WeekData):
+        self.prev_close = week.stock.prev.close
+        self.strike_index = week.strike_index
+        self.lever_index = week.lever_index
+        self.profit_ratios = np.array([c.profit_ratio for c in week.call_options], dtype=float)
+
+
+class Sweep:
+    '''
+    Evaluates the strategies of test-strike-gap.py and test-leverage.py
+    for many parameter values at once, instead of one pass over all weeks per value.
+    '''
+
+    def __init__(self, history: History):
+        self.symbol = history.symbol
+        self.weeks = [WeekArrays(w) for w in history.week_data]
+
+    def profit_ratios(self, pick) -> np.ndarray:
+        '''Matrix of profit ratios (params x weeks) of the calls picked by pick(week)'''
+        return np.column_stack([w.profit_ratios[pick(w)] for w in self.weeks])
+
+    def strike_gap(self, gaps) -> np.ndarray:
+        gaps = np.asarray(gaps, dtype=float)
+        return self.profit_ratios(
+            lambda w: w.strike_index.find_all(w.prev_close * (1 + gaps)))
+
+    def lever(self, levers) -> np.ndarray:
+        levers = np.asarray(levers, dtype=float)
+        return self.profit_ratios(
+            lambda w: w.lever_index.find_all(levers))
+
+    def summary(self, param_name, params, profit_ratios) -> pd.DataFrame:
+        weeks = len(self.weeks)
+        # the sum over weeks is accumulated in week order, like the scripts do
+        profit = np.zeros(len(params))
+        for p in profit_ratios.T:
+            profit += p
+        return pd.DataFrame({
+            'symbol': self.symbol,
+            param_name: params,
+            'average_profit': profit / weeks,
+            'positive': (profit_ratios > 0).sum(axis=1) / weeks,
+        })
+
+
+def sweep_symbol(symbol, strike_gaps=None, levers=None) -> pd.DataFrame:
+    s = Sweep(load_history(symbol))
+    frames = []
+    if strike_gaps is not None:
+        frames.append(s.summary('strike_gap', strike_gaps, s.strike_gap(strike_gaps)))
+    if levers is not None:
+        frames.append(s.summary('lever', levers, s.lever(levers)))
+    return pd.concat(frames, ignore_index=True)
+
+
+def sweep(symbols, strike_gaps=None, levers=None, workers=1) -> pd.DataFrame:
+    '''
+    Average profit and positive ratio of all symbols for each strike gap or leverage.
+    With workers > 1 the symbols are processed in parallel. Each worker process loads
+    the history of its symbol itself, so only the small result tables are sent back.
+    '''
+    if workers > 1:
+        with ProcessPoolExecutor(min(workers, len(symbols))) as pool:
+            frames = list(pool.map(sweep_symbol, symbols, repeat(strike_gaps), repeat(levers)))
+    else:
+        frames = [sweep_symbol(symbol, strike_gaps, levers) for symbol in symbols]
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Tests a strategy with many parameter values over many symbols')
+    parser.add_argument('strategy', choices=('strike-gap', 'lever'))
+    parser.add_argument('start', type=float)
+    parser.add_argument('end', type=float)
+    parser.add_argument('step', type=float,
+                        help='strike gaps are in %%, leverage grows by multiplying with step')
+    parser.add_argument('symbols', nargs='+')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--output', help='save the results to this CSV file')
+    args = parser.parse_args()
+
+    start, end, step = args.start, args.end, args.step
+    if args.strategy == 'strike-gap':
+        df = sweep(args.symbols, strike_gaps=np.arange(start, end + step / 2, step) / 100,
+                   workers=args.workers)
+        grid = df.pivot(index='strike_gap', columns='symbol')
+    else:
+        df = sweep(args.symbols, levers=start * step ** np.arange(np.log(end / start) // np.log(step) + 1),
+                   workers=args.workers)
+        grid = df.pivot(index='lever', columns='symbol')
+    if args.output:
+        df.to_csv(args.output, index=False)
+    with pd.option_context('display.max_rows', None, 'display.width', None,
+                           'display.float_format', '{:.3f}'.format):
+        print(grid)
+
+
+if __name__ == "__main__":
+    main()
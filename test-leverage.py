@@ -4,6 +4,7 @@ import pickle
 from statistics import quantiles
 from itertools import pairwise
 from model import OptionData, WeekData, History, load_history
+from sweep import Sweep
 
 
 def main():
@@ -15,7 +16,6 @@ def main():
 
     history = load_history(symbol)
     print(history)
-    weeks = len(history.week_data)
 
     lever = min(c.leverage for c in history.all_calls)
 
@@ -34,21 +34,19 @@ def main():
     print(
         f'Testing call leverage from {lever:.0f} to {max_lever:.0f} '
         f'at step x{lever_step:.2f}')
+    levers = []
     while lever <= max_lever:
-        profit = 0
-        positive = 0
-        for w in history.week_data:
-            call = w.find_lever(lever)
-            profit += call.profit_ratio
-            if call.profit_ratio > 0:
-                positive += 1
-        # if profit > 0 and positive/weeks > 0.1:
+        levers.append(lever)
+        lever *= lever_step
+    s = Sweep(history)
+    df = s.summary('lever', levers, s.lever(levers))
+    for lever, profit, positive in zip(df.lever, df.average_profit, df.positive):
+        # if profit > 0 and positive > 0.1:
         print(
             f'{lever:.2f}\t'
-            f'average profit {profit/weeks:.1%}\t'
-            f'positive {positive/weeks:.1%}\t'
-            f'{(profit/weeks)*(positive/weeks)*10000:.0f}')
-        lever *= lever_step
+            f'average profit {profit:.1%}\t'
+            f'positive {positive:.1%}\t'
+            f'{profit*positive*10000:.0f}')
 
 
 if __name__ == "__main__":
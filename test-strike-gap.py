@@ -4,6 +4,7 @@ import pickle
 from statistics import quantiles
 from itertools import pairwise
 from model import OptionData, WeekData, History, load_history
+from sweep import Sweep
 
 
 def main():
@@ -23,25 +24,22 @@ def main():
           f'{q:+.02%}' for q in stock_change_quantiles]))
     strike_range = stock_change_quantiles[-1]
 
-    weeks = len(history.week_data)
     strike_step = history.min_strike_gap
     strike_gap = 0
     print(
         f'Testing strike gap from 0 to {strike_range:+.2%} at step {strike_step:.2%}')
+    strike_gaps = []
     while strike_gap <= strike_range:
-        profit = 0
-        positive = 0
-        for w in history.week_data:
-            call = w.find_strike(w.stock.prev.close * (1+strike_gap))
-            profit += call.profit_ratio
-            if call.profit_ratio > 0:
-                positive += 1
+        strike_gaps.append(strike_gap)
+        strike_gap += strike_step
+    s = Sweep(history)
+    df = s.summary('strike_gap', strike_gaps, s.strike_gap(strike_gaps))
+    for strike_gap, profit, positive in zip(df.strike_gap, df.average_profit, df.positive):
         print(
             f'{strike_gap:+.2%}\t'
-            f'average profit {profit/weeks:.1%}\t'
-            f'positive {positive/weeks:.1%}\t'
-            f'{(profit/weeks)*(positive/weeks)*10000:.0f}')
-        strike_gap += strike_step
+            f'average profit {profit:.1%}\t'
+            f'positive {positive:.1%}\t'
+            f'{profit*positive*10000:.0f}')
 
 
 if __name__ == "__main__":